@@ -10,8 +10,12 @@ import pickle
 import copy
 import alphalens4m
 import pandas as pd
-import tushare as ts
 import matplotlib.pyplot as plt
+from tushare_api import get_pro_api, map_concurrent
+from storage import save_table, read_table
+from entity import get_entity_dict
+from universe import in_universe
+from panel_kernel import to_panel, winsorize, min_max
 from helper import *
 import time
 
@@ -28,7 +32,7 @@ _SubFolder = 'patent_invention_utility_count_session'
 _Script = os.path.basename(__file__).rstrip('.py')
 config = get_config(__PATH_FILE, _ConfigFolder, _ConfigFile)
 
-pro = ts.pro_api(token=config.get('token'))    # , timeout=config.get('timeout')
+pro = get_pro_api()
 
 
 @func_timer
@@ -48,12 +52,12 @@ def get_stock_code():
 @func_timer
 def get_daily_basic():
     _codes = get_stock_code()
-    _df_basic = pd.DataFrame()
-    for code in _codes:
+
+    def query_single_stock(code):
         print(code, _codes.index(code), len(_codes))
-        df = pro.daily_basic(ts_code=code, start_date=config.get('start_date'), end_date=config.get('end_date'))
-        _df_basic = pd.concat([_df_basic, df])
-        time.sleep(0.3)  # 每分钟最多访问该接口200次
+        return pro.daily_basic(ts_code=code, start_date=config.get('start_date'), end_date=config.get('end_date'))
+
+    _df_basic = pd.concat(map_concurrent(query_single_stock, _codes))
     print('Got daily data!')
 
     return _df_basic
@@ -62,10 +66,11 @@ def get_daily_basic():
 @func_timer
 def get_bar_data():
     _codes = get_stock_code()
-    _df_bar = pd.DataFrame()
-    for code in _codes:
-        _df = pro.daily(ts_code=code, start_date=config.get('start_date'), end_date=config.get('end_date'))
-        _df_bar = pd.concat([_df_bar, _df])
+
+    def query_single_stock(code):
+        return pro.daily(ts_code=code, start_date=config.get('start_date'), end_date=config.get('end_date'))
+
+    _df_bar = pd.concat(map_concurrent(query_single_stock, _codes))
     print('Got bar data!')
 
     return _df_bar
@@ -83,48 +88,42 @@ def write_pickle_data(pickle_name, data_type, is_run=False):
     else:
         print('Wrong data_type input...')
         return
-    df.to_csv(f'{pickle_name}.csv')
+    save_table(df, pickle_name)
     print("Saved",data_type,'data!')
     # with open(f'{pickle_name}.pkl', 'wb') as f:
     #     joblib.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
 
 
 @func_timer
-def read_pickle_data(pickle_name):
+def read_pickle_data(pickle_name, columns=None):
     # pickle encounter memory error when data size is too big
     # with open(f'{pickle_name}.csv', 'rb') as f:
         # _data = joblib.load(f)
-    _data = pd.read_csv(f'{pickle_name}.csv', dtype={"trade_date": "str", "symbol":"str", "session_end":"str"})
+    _data = read_table(pickle_name, columns=columns)
 
     return _data
 
 
-def winsorize_data(raw_data, left=0.01, right=0.99):
-    q = raw_data.quantile([left, right])
-    raw_data[raw_data < q.iloc[0]] = q.iloc[0]
-    raw_data[raw_data > q.iloc[1]] = q.iloc[1]
-
-    return raw_data
-
-
-def normalize_data(raw_data):
-    x = (raw_data - raw_data.min()) / (raw_data.max() - raw_data.min())
-    return x
-
-
 def process_factor(raw_data, factor_name, key, is_winsorized=True):
+    """
+    winsorize and normalize factor of all dates at once
+    :param raw_data: columns key, symbol and factor_name
+    :return: series of normalized factor, index (key, symbol)
+    """
+    panel, (date_index, stock_index) = to_panel(raw_data, key, 'symbol', [factor_name])
     if is_winsorized:
-        raw_data = raw_data[factor_name].groupby(key).apply(winsorize_data)
-    else:
-        raw_data = raw_data[factor_name]
+        panel = winsorize(panel)
+    factor_normalized = min_max(panel)[date_index, stock_index, 0]
 
-    return raw_data
+    return pd.Series(factor_normalized, index=pd.MultiIndex.from_frame(raw_data[[key, 'symbol']]), name=factor_name)
 
 
 def preprocess_data(df_factor, factor_name, key, bar):
     # factor_name='PAT_M'
     # key='session_end'
 
+    # 只保留可交易股票池内的因子数据
+    df_factor = df_factor[in_universe(df_factor[key], df_factor['symbol'])]
     # 找到bar和factor的最长共有时段的开始日期、结束日期
     df_factor[key] = pd.to_datetime(df_factor[key], format='%Y-%m-%d')
     bar.trade_date = pd.to_datetime(bar.trade_date, format='%Y-%m-%d')
@@ -139,13 +138,11 @@ def preprocess_data(df_factor, factor_name, key, bar):
         & (df_factor['trade_date'] <= end_date)]
     bar = bar[(bar['trade_date'] >= start_date) & (bar['trade_date'] <= end_date)]
     symbol_for_factor = df_factor.symbol.tolist()
-    bar['symbol'] = bar['ts_code'].apply(lambda x: x.split('.')[0])
+    bar['symbol'] = get_entity_dict().convert(bar['ts_code'], 'ts_code', 'symbol')
     bar = bar[(bar.symbol.isin(symbol_for_factor))][['trade_date', 'symbol', 'close']]
     
     # 处理因子数据
-    df_factor_new = df_factor.set_index(['trade_date', 'symbol'])
-    _factor = process_factor(df_factor_new, factor_name, 'trade_date', is_winsorized=True)    # Series
-    factor_normalized = _factor.groupby('trade_date').apply(normalize_data)
+    factor_normalized = process_factor(df_factor, factor_name, 'trade_date', is_winsorized=True)    # Series
     print(factor_normalized.head())
 
     # 画出因子分布图
@@ -334,7 +331,7 @@ def back_test(factor, price, auto_bins=False, quantiles=None, bins=None, periods
 if __name__ == '__main__':
     bar_pickle = 'daily_bar'
     write_pickle_data(bar_pickle, data_type='bar', is_run=False)
-    data_bar = read_pickle_data(bar_pickle)
-    data_factor = read_pickle_data(os.path.join(_OutputFolder, _SubFolder, _SubFolder))
+    data_bar = read_pickle_data(bar_pickle, columns=['ts_code', 'trade_date', 'close'])
+    data_factor = read_pickle_data(_SubFolder, columns=['symbol', 'session_end', 'PAT_M'])
     factors, prices = preprocess_data(data_factor, 'PAT_M', 'session_end', data_bar)
     back_test(factors, prices, auto_bins=True, quantiles=[.5, .7, .9, .95])
\ No newline at end of file
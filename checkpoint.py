@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+    resumable checkpoint for long tushare downloads
+    results are written to Output/Checkpoint/<job>/ batch by batch while the download runs, together with a manifest
+    of the completed items, a rerun skips completed items and does not spend api quota on them again
+    an item is completed only if it returned data, items returning None (e.g. a transient error swallowed by
+    ts.pro_bar) are recorded as empty and queried again by the next run
+"""
+__auth__ = 'Chen Chen'
+
+import numpy as np
+import pandas as pd
+from tushare_api import map_concurrent
+from helper import *
+
+__PATH_FILE = os.path.dirname(__file__)
+_ConfigFolder = 'Config'
+_ConfigFile = 'config.json'
+_OutputFolder = 'Output'
+_CheckpointFolder = 'Checkpoint'
+_ManifestFile = 'manifest.json'
+_Script = os.path.basename(__file__).rstrip('.py')
+config = get_config(__PATH_FILE, _ConfigFolder, _ConfigFile)
+_PATH_CHECKPOINT = os.path.join(__PATH_FILE, _OutputFolder, _CheckpointFolder)
+
+
+class Checkpoint(object):
+    """
+    :param job: name of the download, e.g. stock_bar_marketcap
+    :param params: parameters of the download, e.g. start/end date, checkpoint of other parameters is discarded
+    :param batch_size: items per batch file, default is checkpoint_batch_size in config.json
+    """
+
+    def __init__(self, job, params=None, batch_size=None):
+        self.job = job
+        self.params = params or dict()
+        self.batch_size = int(batch_size or config.get('checkpoint_batch_size'))
+        self.path_folder = os.path.join(_PATH_CHECKPOINT, job)
+        self.manifest = self._read_manifest()
+
+    def _read_manifest(self):
+        path_manifest = os.path.join(self.path_folder, _ManifestFile)
+        if os.path.exists(path_manifest):
+            with open(path_manifest, encoding='utf-8') as f:
+                manifest = json.loads(f.read())
+            # rows of every item are needed to return the requested items only
+            if manifest['params'] == self.params and all('rows' in batch for batch in manifest['batches']):
+                return manifest
+            emit_log(config, _Script, f"{self.job}: parameters changed, checkpoint discarded.")
+            self.clear()
+        return {'params': self.params, 'batches': list()}
+
+    def _write_manifest(self):
+        path_manifest = os.path.join(self.path_folder, _ManifestFile)
+        # write to a temporary file first, a crash never leaves a broken manifest
+        with open(f"{path_manifest}.tmp", 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self.manifest, ensure_ascii=False))
+        os.replace(f"{path_manifest}.tmp", path_manifest)
+
+    def completed_items(self):
+        return {item for batch in self.manifest['batches'] for item in batch['items']}
+
+    def run(self, func, items):
+        """
+        run func(item) concurrently for items not completed yet, batch by batch, and save each batch
+        :param func: function querying tushare for a single item, returns dataframe or None
+        :param items: list of items, e.g. stock codes or trade dates
+        :return: dataframe of all items, in the same order as items if the items are unchanged between reruns
+        """
+        os.makedirs(self.path_folder, exist_ok=True)
+        completed = self.completed_items().intersection(items)
+        items_pending = [item for item in items if item not in completed]
+        emit_log(config, _Script, f"{self.job}: {len(completed)} items completed, {len(items_pending)} items pending.")
+        for i in range(0, len(items_pending), self.batch_size):
+            items_batch = items_pending[i:i + self.batch_size]
+            results = map_concurrent(func, items_batch)
+            items_data = [item for item, df in zip(items_batch, results) if df is not None]
+            df_list = [df for df in results if df is not None]
+            file_batch = None
+            if df_list:
+                file_batch = f"batch_{len(self.manifest['batches']):05d}.parquet"
+                pd.concat(df_list, ignore_index=True).to_parquet(os.path.join(self.path_folder, file_batch),
+                                                                 index=False)
+            self.manifest['batches'].append({'file': file_batch, 'items': items_data,
+                                             'rows': [len(df) for df in df_list],
+                                             'empty': [item for item in items_batch if item not in items_data]})
+            self._write_manifest()
+            emit_log(config, _Script, f"{self.job}: checkpoint {file_batch} saved, "
+                                      f"{len(self.completed_items().intersection(items))}/{len(items)} items completed.")
+
+        # rows of the requested items only, a checkpoint may hold items of a previous run with other items
+        items_requested = set(items)
+        df_by_item = dict()
+        for batch in self.manifest['batches']:
+            if batch['file'] is None or items_requested.isdisjoint(batch['items']):
+                continue
+            df_batch = pd.read_parquet(os.path.join(self.path_folder, batch['file']))
+            offsets = np.cumsum([0] + batch['rows'])
+            for item, start, end in zip(batch['items'], offsets[:-1], offsets[1:]):
+                if item in items_requested:
+                    df_by_item[item] = df_batch.iloc[start:end]
+        df_list = [df_by_item[item] for item in items if item in df_by_item]
+
+        return pd.concat(df_list, ignore_index=True) if df_list else pd.DataFrame()
+
+    def clear(self):
+        clear_checkpoint(self.job)
+        self.manifest = {'params': self.params, 'batches': list()}
+
+
+def clear_checkpoint(job):
+    """
+    remove the checkpoint of a job, call it once the final output is saved
+    """
+    path_folder = os.path.join(_PATH_CHECKPOINT, job)
+    if os.path.exists(path_folder):
+        for file in os.listdir(path_folder):
+            os.remove(os.path.join(path_folder, file))
+        os.rmdir(path_folder)
@@ -1,14 +1,21 @@
 # -*- coding: utf-8 -*-
 """
-    1. query data for Listed/Delisted/Pending from Tushare and save to csv file
-    2. query back adjust (qfq) data and save to csv file
-    3. query st/pt stocks and save to csv file
+    1. query data for Listed/Delisted/Pending from Tushare and save to table
+    2. query back adjust (qfq) data and save to table
+    3. query st/pt stocks and save to table
+    4. query shibor curve of the whole range once and save to table
     basic_information/qfq/stpt files are used to calculate excess return in factor_processing.py
 """
 __auth__ = 'Chen Chen'
 
 import tushare as ts
+import numpy as np
 import pandas as pd
+from dateutil.relativedelta import relativedelta
+from trade_calendar import get_session_table, get_trade_calendar
+from tushare_api import get_pro_api, map_concurrent
+from checkpoint import Checkpoint, clear_checkpoint
+from storage import save_table, append_table, read_table
 from helper import *
 
 __PATH_FILE = os.path.dirname(__file__)
@@ -54,8 +61,7 @@ def get_stock_basic_listed(fields):
     2     000004.SZ     000004      国农科技    深圳         生物制药        19910114
     6     000008.SZ     000008      神州高铁    北京         运输设备        19920507
     """
-    token = config.get('token')
-    pro = ts.pro_api(token=token, timeout=float(config.get('timeout')))
+    pro = get_pro_api()
     _df_stock_basic = pro.stock_basic(list_status='L', fields=fields)
 
     return _df_stock_basic
@@ -95,8 +101,7 @@ def get_stock_basic_delisted(fields):
     2     000004.SZ     000004      国农科技    深圳         生物制药        19910114
     6     000008.SZ     000008      神州高铁    北京         运输设备        19920507
     """
-    token = config.get('token')
-    pro = ts.pro_api(token=token, timeout=float(config.get('timeout')))
+    pro = get_pro_api()
     _df_stock_basic = pro.stock_basic(list_status='D', fields=fields)
 
     return _df_stock_basic
@@ -136,18 +141,16 @@ def get_stock_basic_pending(fields):
     2     000004.SZ     000004      国农科技    深圳         生物制药        19910114
     6     000008.SZ     000008      神州高铁    北京         运输设备        19920507
     """
-    token = config.get('token')
-    pro = ts.pro_api(token=token, timeout=float(config.get('timeout')))
+    pro = get_pro_api()
     _df_stock_basic = pro.stock_basic(list_status='P', fields=fields)
 
     return _df_stock_basic
 
 
 def get_daily_bar_from_tushare():
-    token = config.get('token')
     start_date = config.get('start_date')
     end_date = config.get('end_date')
-    pro = ts.pro_api(token=token, timeout=float(config.get('timeout')))
+    pro = get_pro_api()
     _df_daily_bar = pro.daily(ts_code='000001.sz', start_date=start_date, end_date=end_date)
     # print(_df_daily_bar.head())
     _df_daily_bar.set_index("trade_date", drop=True, inplace=True)
@@ -215,27 +218,185 @@ def get_qfq_bar_data(code_list):
     20181008    000001.SZ   20181008        1155.93     1165.65     1128.92  1128.92
     20180928    000001.SZ   20180928        1164.57     1217.51     1164.57  1193.74
     """
-    token = config.get('token')
-    pro = ts.pro_api(token=token, timeout=float(config.get('timeout')))
+    pro = get_pro_api()
     start_date = config.get('start_date')
     end_date = config.get('end_date')
     if end_date == -1:
         end_date = datetime.datetime.today().strftime('%Y%m%d')
-    df_all_bar_merge_mv = pd.DataFrame()
-    for stock_code in code_list:
+
+    def query_single_stock(stock_code):
         emit_log(config, _Script, f"query data {stock_code} {code_list.index(stock_code)}/{len(code_list)}")
-        bar_data = ts.pro_bar(ts_code=stock_code, api=pro, adj='qfq', start_date=start_date, end_date=end_date)
-        # time.sleep(0.6)
-        if bar_data is not None:    # e.g. 000003.SZ was particular transferred (PT), no bar
-            bar_data = bar_data[['ts_code', 'trade_date', 'close', 'vol']]
-            daily_basic_data = pro.daily_basic(ts_code=stock_code, start_date=start_date, end_date=end_date)[
-                ['trade_date', 'total_mv']]
-            df_single_stock_bar_merge_mv = pd.merge(bar_data, daily_basic_data, on='trade_date', how='left')
-            df_all_bar_merge_mv = pd.concat([df_all_bar_merge_mv, df_single_stock_bar_merge_mv], ignore_index=True)
+        pro.pop_offline_miss()
+        try:
+            bar_data = ts.pro_bar(ts_code=stock_code, api=pro, adj='qfq', start_date=start_date, end_date=end_date)
+        finally:
+            # ts.pro_bar swallows the error of a cache miss offline, fail instead of dropping the stock
+            offline_miss = pro.pop_offline_miss()
+            if offline_miss is not None:
+                raise IOError(f"{offline_miss} is not cached, can not replay offline.")
+        if bar_data is None:    # e.g. 000003.SZ was particular transferred (PT), no bar
+            return None
+        bar_data = bar_data[['ts_code', 'trade_date', 'close', 'vol']]
+        daily_basic_data = pro.daily_basic(ts_code=stock_code, start_date=start_date, end_date=end_date)[
+            ['trade_date', 'total_mv']]
+        return pd.merge(bar_data, daily_basic_data, on='trade_date', how='left')
+
+    # query stocks concurrently batch by batch, each batch is checkpointed, results keep the order of code_list
+    checkpoint = Checkpoint('stock_bar_marketcap', params={'start_date': start_date, 'end_date': end_date})
+    df_all_bar_merge_mv = checkpoint.run(query_single_stock, code_list)
 
     return df_all_bar_merge_mv
 
 
+def get_trade_date_list(start_date, end_date):
+    """
+    :return: list of open trade dates between start_date and end_date, ascending
+    """
+    return get_trade_calendar().get_trade_dates(start_date, end_date)
+
+
+def get_session_snapshot_date_list():
+    """
+    calculate_excess_return only needs bars on session end dates and forward month ends (1/3/6/12 months later),
+    so only those snapshot dates are queried instead of every trade date
+    :return: list of snapshot trade dates, ascending
+    """
+    session_end_date_list = get_session_table({'M': 1})['session_end'].tolist()
+    # last trade date of forward months after the last session, the longest horizon is 12 months
+    forward_end_date_list = get_trade_calendar().last_trade_date_of_month(session_end_date_list[-1],
+                                                                          months=np.arange(1, 13)).tolist()
+    # forward months in the future have no bar yet
+    today = datetime.datetime.today().strftime('%Y%m%d')
+    forward_end_date_list = [date for date in forward_end_date_list if date <= today]
+
+    return sorted(set(session_end_date_list + forward_end_date_list))
+
+
+def adjust_qfq_close(df_bar, adj_factor_latest=None):
+    """
+    rebuild qfq close locally, the same way as ts.pro_bar(adj='qfq'):
+        close_qfq = close * adj_factor / latest adj_factor of the stock
+    :param df_bar: raw bar data with columns ts_code, trade_date, close, adj_factor
+    :param adj_factor_latest: series of latest adj_factor indexed by ts_code, default is the latest in df_bar
+    :return: dataframe with adjusted close, sorted by ts_code and trade_date descending
+    """
+    df_bar = df_bar.sort_values(['ts_code', 'trade_date'], ascending=[True, False], ignore_index=True)
+    # missing adj_factor of a stock (e.g. new listed stock) is filled with its neighbour dates
+    df_bar['adj_factor'] = df_bar.groupby('ts_code')['adj_factor'].transform(lambda x: x.bfill().ffill())
+    if adj_factor_latest is None:
+        latest_adj_factor = df_bar.groupby('ts_code')['adj_factor'].transform('first')
+    else:
+        latest_adj_factor = df_bar['ts_code'].map(adj_factor_latest)
+    df_bar['close'] = (df_bar['close'] * df_bar['adj_factor'] / latest_adj_factor).round(2)
+
+    return df_bar
+
+
+@func_timer
+def get_qfq_bar_data_by_trade_date(trade_date_list):
+    """
+    描述：按交易日获取全市场行情，在本地计算前复权收盘价，输出与get_qfq_bar_data相同的字段
+    每个交易日请求3次（daily、adj_factor、daily_basic），请求次数与交易日数量成正比，与股票数量无关
+
+    接口：daily/adj_factor/daily_basic
+    输入参数：
+    名称	    类型	    必选	    描述
+    ts_code	    str	        N	        股票代码（二选一）
+    trade_date	str	        N	        交易日期 （二选一）
+    start_date	str	        N	        开始日期(YYYYMMDD)
+    end_date	str	        N	        结束日期(YYYYMMDD)
+
+    输出参数：
+    名称	    类型	    描述
+    ts_code	    str	        股票代码
+    trade_date	str	        交易日期
+    close	    float	    收盘价（前复权）
+    vol	        float	    成交量 （手）
+    total_mv	float	    总市值 （万元）
+    """
+    df_all_bar_merge_mv = adjust_qfq_close(get_bar_data_by_trade_date(trade_date_list))
+
+    return df_all_bar_merge_mv[['ts_code', 'trade_date', 'close', 'vol', 'total_mv']]
+
+
+def get_bar_data_by_trade_date(trade_date_list):
+    """
+    :param trade_date_list: trade dates to query
+    :return: unadjusted bar data of the whole market, columns ts_code, trade_date, close, vol, adj_factor, total_mv
+    """
+    pro = get_pro_api()
+
+    def query_single_date(trade_date):
+        emit_log(config, _Script, f"query data {trade_date} {trade_date_list.index(trade_date)}/{len(trade_date_list)}")
+        bar_data = pro.daily(trade_date=trade_date, fields='ts_code,trade_date,close,vol')
+        adj_factor_data = pro.adj_factor(trade_date=trade_date, fields='ts_code,trade_date,adj_factor')
+        daily_basic_data = pro.daily_basic(trade_date=trade_date, fields='ts_code,trade_date,total_mv')
+        df_bar_single_date = pd.merge(bar_data, adj_factor_data, on=['ts_code', 'trade_date'], how='left')
+        return pd.merge(df_bar_single_date, daily_basic_data, on=['ts_code', 'trade_date'], how='left')
+
+    # query trade dates concurrently batch by batch, each batch is checkpointed, results keep the order of trade dates
+    checkpoint = Checkpoint('stock_bar_trade_date', params={'start_date': trade_date_list[0],
+                                                            'end_date': trade_date_list[-1],
+                                                            'trade_date_count': len(trade_date_list)})
+
+    return checkpoint.run(query_single_date, trade_date_list)
+
+
+@func_timer
+def update_qfq_bar_data_incremental(end_date):
+    """
+    incremental update of stock_bar_marketcap:
+        1. find the last stored trade_date of each ts_code, query newer trade dates only
+        2. append new unadjusted bars to table stock_bar_daily partitioned by month
+        3. qfq close of the stocks whose latest adj_factor changed (e.g. dividend) is re-adjusted from the store,
+           the other stocks keep their rows and get the new rows appended
+    :param end_date: last trade date to update
+    :return: updated qfq bar data, same fields as get_qfq_bar_data
+    """
+    fields = ['ts_code', 'trade_date', 'close', 'vol', 'total_mv']
+
+    # 1. query trade dates after the stored ones
+    df_stored = read_table('stock_bar_daily', columns=['ts_code', 'trade_date'])
+    last_trade_date_by_code = df_stored.groupby('ts_code')['trade_date'].max()
+    if df_stored.empty:
+        start_date = config.get('start_date')
+    else:
+        start_date = (pd.to_datetime(last_trade_date_by_code.max()) + relativedelta(days=1)).strftime('%Y%m%d')
+    trade_date_list = get_trade_date_list(start_date, end_date)
+    emit_log(config, _Script, f"{len(trade_date_list)} trade dates to update from {start_date} to {end_date}")
+    if not trade_date_list:
+        return read_table('stock_bar_marketcap')
+    df_bar_new = get_bar_data_by_trade_date(trade_date_list)
+    # only keep rows newer than the last stored trade date of each stock
+    df_bar_new = df_bar_new[df_bar_new['trade_date'] > df_bar_new['ts_code'].map(last_trade_date_by_code).fillna('')]
+
+    # 2. append to the store
+    append_table(df_bar_new, 'stock_bar_daily', keys=['ts_code', 'trade_date'])
+
+    # 3. find stocks whose latest adj_factor changed
+    adj_factor_latest_old = read_table('stock_adj_factor_latest').set_index('ts_code')['adj_factor'].astype('float64')
+    adj_factor_latest_new = df_bar_new.dropna(subset=['adj_factor']).sort_values('trade_date').groupby('ts_code')[
+        'adj_factor'].last()
+    adj_factor_latest = adj_factor_latest_new.combine_first(adj_factor_latest_old)
+    codes_stored = adj_factor_latest_old.index.intersection(adj_factor_latest_new.index)
+    codes_changed = codes_stored[adj_factor_latest_old[codes_stored] != adj_factor_latest_new[codes_stored]].tolist()
+    emit_log(config, _Script, f"{len(codes_changed)} stocks have new adj_factor, re-adjust them")
+
+    # re-adjust changed stocks from the store, append new rows of the others
+    df_qfq_old = read_table('stock_bar_marketcap', columns=fields)
+    df_qfq_old = df_qfq_old[~df_qfq_old['ts_code'].isin(codes_changed)]
+    df_qfq_readjust = adjust_qfq_close(read_table('stock_bar_daily', filters=[('ts_code', 'in', codes_changed)]),
+                                       adj_factor_latest)
+    df_qfq_new = adjust_qfq_close(df_bar_new[~df_bar_new['ts_code'].isin(codes_changed)], adj_factor_latest)
+    df_qfq = pd.concat([df_qfq_old, df_qfq_readjust[fields], df_qfq_new[fields]], ignore_index=True)
+    # e.g. the first incremental run after a full fetch queries the whole history again, new rows win
+    df_qfq = df_qfq.drop_duplicates(['ts_code', 'trade_date'], keep='last')
+    df_qfq = df_qfq.sort_values(['ts_code', 'trade_date'], ascending=[True, False], ignore_index=True)
+    save_table(adj_factor_latest.rename_axis('ts_code').reset_index(), 'stock_adj_factor_latest')
+
+    return df_qfq
+
+
 @func_timer
 def get_namechange_stock(code_list):
     """
@@ -264,18 +425,38 @@ def get_namechange_stock(code_list):
     4   600848.SH       ST自仪      20010508      20061008         ST
     5   600848.SH       自仪股份    19940324      20010507         其他
     """
-    token = config.get('token')
-    pro = ts.pro_api(token=token, timeout=float(config.get('timeout')))
-    df_namechange = pd.DataFrame()
-    for code in code_list:
-        namechange_data = pro.namechange(ts_code=code, start_date=config.get('start_date'), fields='')
-        df_namechange = pd.concat([df_namechange, namechange_data], axis=0, ignore_index=True)
-        time.sleep(0.6)  # maximum 100 request quotas per minute
+    pro = get_pro_api()
+
+    def query_single_stock(code):
+        return pro.namechange(ts_code=code, start_date=config.get('start_date'), fields='')
+
+    # query stocks concurrently batch by batch, each batch is checkpointed, results keep the order of code_list
+    checkpoint = Checkpoint('stock_namechange', params={'start_date': config.get('start_date')})
+    df_namechange = checkpoint.run(query_single_stock, code_list)
     # df_stpt = df_namechange[df_namechange['name'].str.contains('ST')]
 
     return df_namechange
 
 
+@func_timer
+def get_shibor_curve(start_date, end_date):
+    """
+    shibor fixings of every tenor between start_date and end_date, queried year by year since a query returns at most
+    2000 rows
+    :return: dataframe, columns date, on, 1w, 2w, 1m, 3m, 6m, 9m, 1y, date ascending
+    """
+    pro = get_pro_api()
+
+    def query_single_year(year):
+        return pro.shibor(start_date=max(start_date, f"{year}0101"), end_date=min(end_date, f"{year}1231"))
+
+    year_list = list(range(int(start_date[:4]), int(end_date[:4]) + 1))
+    df_shibor = pd.concat(map_concurrent(query_single_year, year_list), ignore_index=True)
+    emit_log(config, _Script, f"{len(df_shibor)} shibor fixings between {start_date} and {end_date}.")
+
+    return df_shibor.drop_duplicates('date').sort_values('date', ignore_index=True)
+
+
 @func_timer
 def main():
     emit_log(config, _Script, f"Program starts...")
@@ -284,20 +465,48 @@ def main():
     df_stock_basic_overall = concat_stock_basic(fields)
     # print(df_stock_basic_overall)
 
-    # save to csv file
-    file_stock_basic_overall = f"stock_basic_overall.csv"
-    save_dataframe(df_stock_basic_overall, file_stock_basic_overall)
+    # save to table
+    save_table(df_stock_basic_overall, 'stock_basic_overall')
 
     # list all stocks selected
     stock_code_list = df_stock_basic_overall['ts_code'].tolist()
 
     # # query back adjust bar data
-    df_bar_mv = get_qfq_bar_data(stock_code_list)
-    save_dataframe(df_bar_mv, f"stock_bar_marketcap.csv")
+    # fetch_mode: stock, query stock by stock; trade_date, query whole market trade date by trade date;
+    # session, query whole market on session end dates only, which is enough for excess return;
+    # incremental, query trade dates after the last stored ones and append
+    if config.get('fetch_mode') == 'incremental':
+        end_date = config.get('end_date')
+        if end_date == -1:
+            end_date = datetime.datetime.today().strftime('%Y%m%d')
+        df_bar_mv = update_qfq_bar_data_incremental(end_date)
+    elif config.get('fetch_mode') == 'session':
+        snapshot_date_list = get_session_snapshot_date_list()
+        df_bar_mv = get_qfq_bar_data_by_trade_date(snapshot_date_list)
+    elif config.get('fetch_mode') == 'trade_date':
+        end_date = config.get('end_date')
+        if end_date == -1:
+            end_date = datetime.datetime.today().strftime('%Y%m%d')
+        trade_date_list = get_trade_date_list(config.get('start_date'), end_date)
+        df_bar_mv = get_qfq_bar_data_by_trade_date(trade_date_list)
+    else:
+        df_bar_mv = get_qfq_bar_data(stock_code_list)
+    save_table(df_bar_mv, 'stock_bar_marketcap')
 
     # # find out st/pt stocks
     df_namechange = get_namechange_stock(stock_code_list)
-    save_dataframe(df_namechange, f"stock_namechange.csv")
+    save_table(df_namechange, 'stock_namechange')
+
+    # # shibor curve as risk free rate of excess return
+    end_date = config.get('end_date')
+    if end_date == -1:
+        end_date = datetime.datetime.today().strftime('%Y%m%d')
+    df_shibor = get_shibor_curve(config.get('start_date'), end_date)
+    save_table(df_shibor, 'shibor')
+
+    # all outputs are saved, remove checkpoints so that the next run starts over
+    for job in ['stock_bar_marketcap', 'stock_bar_trade_date', 'stock_namechange']:
+        clear_checkpoint(job)
     emit_log(config, _Script, f"All finished.")
 
 
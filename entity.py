@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+    integer entity dictionary shared by all scripts
+    every listed company gets a dense int32 entity_id, which maps ts_code (tushare), symbol and bbd_qyxx_id
+    (data warehouse), the dictionary is kept as table entity in Output, ids of known companies never change and new
+    companies are appended, so entity_id can be stored in other tables
+    string keys of raw data are encoded once when they are read, tables patent_count_session, rd_cost, excess_return
+    and factor carry entity_id, and are joined on it by array indexing (join_on_entity)
+"""
+__auth__ = 'Chen Chen'
+
+import numpy as np
+import pandas as pd
+from storage import save_table, read_table, exists_table
+from helper import *
+
+__PATH_FILE = os.path.dirname(__file__)
+_ConfigFolder = 'Config'
+_ConfigFile = 'config.json'
+_InputFolder = 'Input'
+_Script = os.path.basename(__file__).rstrip('.py')
+config = get_config(__PATH_FILE, _ConfigFolder, _ConfigFile)
+ENTITY_KEYS = ['ts_code', 'symbol', 'bbd_qyxx_id']
+
+_entity_dict = None
+
+
+class EntityDict(object):
+    """
+    :param df_entity: columns entity_id and ENTITY_KEYS, entity_id is 0, 1, 2, ...
+    """
+
+    def __init__(self, df_entity):
+        self.df_entity = df_entity.sort_values('entity_id', ignore_index=True)
+        # key value -> entity_id, missing values are not indexed
+        self._index = dict()
+        for key in ENTITY_KEYS:
+            df = self.df_entity[self.df_entity[key].notnull()].drop_duplicates(key)
+            self._index[key] = (pd.Index(df[key]), df['entity_id'].to_numpy())
+
+    def __len__(self):
+        return len(self.df_entity)
+
+    def encode(self, values, key='symbol'):
+        """
+        :param values: values of key, e.g. symbols; for a categorical series only the categories are looked up, and
+                       rows are encoded by indexing with the category codes
+        :param key: one of ENTITY_KEYS
+        :return: int32 array of entity_id, -1 for unknown values
+        """
+        if isinstance(getattr(values, 'dtype', None), pd.CategoricalDtype):
+            # the last slot is for missing values (code -1)
+            category_ids = np.append(self.encode(values.cat.categories, key), -1).astype('int32')
+            return category_ids[values.cat.codes.to_numpy()]
+        index, entity_ids = self._index[key]
+        position = index.get_indexer(np.asarray(values))
+        return np.where(position >= 0, entity_ids[position], -1).astype('int32')
+
+    def decode(self, entity_ids, key='symbol'):
+        """
+        :param entity_ids: int array of entity_id, -1 for unknown
+        :param key: one of ENTITY_KEYS
+        :return: object array of values of key, None for unknown
+        """
+        entity_ids = np.asarray(entity_ids)
+        values = self.df_entity[key].to_numpy(dtype=object)[np.maximum(entity_ids, 0)]
+        return np.where(entity_ids >= 0, values, None)
+
+    def convert(self, values, from_key, to_key):
+        """
+        e.g. convert(ts_codes, 'ts_code', 'symbol'), a ts_code unknown to the dictionary falls back to its code part
+        (000001.SZ -> 000001), other values without to_key raise KeyError
+        """
+        values = np.asarray(values, dtype=object)
+        converted = self.decode(self.encode(values, from_key), to_key)
+        missing = pd.isnull(converted)
+        if missing.any():
+            if from_key == 'ts_code' and to_key == 'symbol':
+                converted[missing] = [value.split('.')[0] for value in values[missing]]
+            else:
+                raise KeyError(f"{missing.sum()} values of {from_key} have no {to_key}, e.g. {values[missing][0]}.")
+        return converted
+
+    def get_company(self):
+        """
+        :return: companies of company_list_withid.csv, columns entity_id, symbol, bbd_qyxx_id
+        """
+        return self.df_entity.loc[self.df_entity['bbd_qyxx_id'].notnull(), ['entity_id', 'symbol', 'bbd_qyxx_id']]
+
+
+def _read_entity_source():
+    # symbols of tushare and data warehouse, one row per symbol
+    df_company = pd.read_csv(os.path.join(__PATH_FILE, _InputFolder, 'company_list_withid.csv'),
+                             usecols=['symbol', 'bbd_qyxx_id'], dtype={'symbol': str, 'bbd_qyxx_id': str})
+    df_company['symbol'] = df_company['symbol'].str.zfill(6)
+    df_stock_basic = read_table('stock_basic_overall', columns=['ts_code', 'symbol'])
+    df_source = pd.merge(df_stock_basic, df_company, how='outer', on='symbol')
+
+    return df_source.drop_duplicates('symbol').sort_values('symbol', ignore_index=True)[ENTITY_KEYS]
+
+
+@func_timer
+def update_entity_table():
+    """
+    add new companies of stock_basic_overall and company_list_withid.csv to table entity, fill keys found since last
+    update, existing entity_id is kept
+    :return: dataframe of table entity
+    """
+    df_source = _read_entity_source()
+    df_entity = read_table('entity') if exists_table('entity') else pd.DataFrame(columns=['entity_id'] + ENTITY_KEYS)
+    df_entity = df_entity.astype({'entity_id': 'int32'})
+    # keys known now, entity_id of known symbols
+    df_merge = pd.merge(df_entity[['entity_id', 'symbol']], df_source, how='outer', on='symbol')
+    df_merge = df_merge.sort_values(['entity_id', 'symbol'], na_position='last', ignore_index=True)
+    is_new = df_merge['entity_id'].isnull().to_numpy()
+    df_merge.loc[is_new, 'entity_id'] = len(df_entity) + np.arange(is_new.sum())
+    # keys dropped from sources are kept
+    df_merge = df_merge.set_index('entity_id').combine_first(df_entity.set_index('entity_id')).reset_index()
+    df_merge = df_merge.astype({'entity_id': 'int32'})[['entity_id'] + ENTITY_KEYS]
+    if is_new.any() or not df_merge.equals(df_entity.reset_index(drop=True)):
+        save_table(df_merge, 'entity')
+        emit_log(config, _Script, f"{is_new.sum()} new entities, {len(df_merge)} entities saved.")
+
+    return df_merge
+
+
+def get_entity_dict():
+    """
+    :return: entity dictionary shared by the whole process, updated once from the sources
+    """
+    global _entity_dict
+    if _entity_dict is None:
+        _entity_dict = EntityDict(update_entity_table())
+    return _entity_dict
+
+
+def join_on_entity(df_left, df_right, columns, date_column='session_end'):
+    """
+    left join columns of df_right to df_left on (entity_id, date_column) by array indexing: df_right is scattered into
+    a dense date x entity array, which is gathered at the rows of df_left
+    :param df_left: columns entity_id and date_column, entity_id -1 for unknown companies
+    :param df_right: columns entity_id, date_column and columns, one row per entity_id and date
+    :param columns: columns of df_right to join
+    :param date_column: e.g. session_end
+    :return: copy of df_left with columns, nan where df_right has no row
+    :raise ValueError: if df_right has more than one row of an entity_id and date
+    """
+    right_date_value, left_date_value = df_right[date_column].to_numpy(), df_left[date_column].to_numpy()
+    right_entity = df_right['entity_id'].to_numpy(dtype='int64')
+    left_entity = df_left['entity_id'].to_numpy(dtype='int64')
+    dates = np.unique(right_date_value)
+    n_entity = int(max(right_entity.max(initial=-1), left_entity.max(initial=-1))) + 1
+    right_date = np.searchsorted(dates, right_date_value)
+    has_entity = right_entity >= 0
+    n_duplicated = has_entity.sum() - len(np.unique(right_date[has_entity] * n_entity + right_entity[has_entity]))
+    if n_duplicated > 0:
+        raise ValueError(f"{n_duplicated} duplicated rows of entity_id and {date_column}.")
+    # the last date and the last entity are all nan slots, for rows of df_left without a match
+    values = np.full((len(dates) + 1, n_entity + 1, len(columns)), np.nan)
+    values[right_date[has_entity], right_entity[has_entity]] = \
+        df_right.loc[has_entity, columns].to_numpy(dtype='float64')
+    left_date = np.searchsorted(dates, left_date_value)
+    found_date = dates[np.minimum(left_date, max(len(dates) - 1, 0))] == left_date_value if len(dates) > 0 else False
+    left_date = np.where(found_date, left_date, len(dates))
+    df_join = df_left.copy()
+    df_join[columns] = values[left_date, np.where(left_entity >= 0, left_entity, n_entity)]
+
+    return df_join
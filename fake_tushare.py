@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+    local fake of tushare pro api, used to run and benchmark the download pipeline offline
+    it answers the endpoints used in this project with deterministic synthetic data and a fixed network latency:
+        stock_basic, trade_cal, daily, adj_factor, daily_basic, namechange, shibor
+    set "tushare_backend": "fake" in config.json to use it through tushare_api.get_pro_api()
+"""
+__auth__ = 'Chen Chen'
+
+import threading
+import numpy as np
+import pandas as pd
+from helper import *
+
+_FAKE_START_DATE = '20100101'
+_FAKE_END_DATE = '20251231'
+
+
+class FakeProApi(object):
+    """
+    :param latency: seconds slept by every request, to simulate network round trip
+    :param stock_count: number of stocks in the fake market
+    :param seed: random seed of the synthetic data
+    """
+
+    def __init__(self, latency=0.0, stock_count=300, seed=0):
+        self.latency = latency
+        self.stock_count = stock_count
+        self.seed = seed
+        self._panel = None
+        self._lock = threading.Lock()
+
+    def query(self, api_name, fields='', **kwargs):
+        time.sleep(self.latency)
+        df = getattr(self, f'_{api_name}')(**kwargs)
+        if fields:
+            df = df[[field.strip() for field in fields.split(',')]]
+        return df.reset_index(drop=True)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def _query(fields='', **kwargs):
+            return self.query(name, fields=fields, **kwargs)
+
+        return _query
+
+    def _get_panel(self):
+        # synthetic market is generated once, trade date x stock
+        with self._lock:
+            if self._panel is None:
+                rng = np.random.RandomState(self.seed)
+                cal_dates = pd.date_range(_FAKE_START_DATE, _FAKE_END_DATE, freq='D')
+                trade_dates = cal_dates[cal_dates.dayofweek < 5]
+                n_date, n_stock = len(trade_dates), self.stock_count
+                ts_codes = [f"{i + 1:06d}.SZ" if i % 2 == 0 else f"{600000 + i:06d}.SH" for i in range(n_stock)]
+                list_index = rng.randint(0, n_date // 2, n_stock)
+                returns = rng.normal(0, 0.02, (n_date, n_stock))
+                close = np.round(10 * np.exp(np.cumsum(returns, axis=0)), 2)
+                # dividends make adj_factor step up now and then
+                adj_factor = np.round(np.cumprod(1 + (rng.rand(n_date, n_stock) < 0.002) * 0.05, axis=0), 3)
+                total_share = rng.uniform(1E+4, 1E+6, n_stock)
+                pre_close = np.vstack([close[:1], close[:-1]])
+                vol = np.round(rng.uniform(1E+3, 1E+5, (n_date, n_stock)), 2)
+                self._panel = {
+                    'trade_date': trade_dates.strftime('%Y%m%d').to_numpy(),
+                    'cal_date': cal_dates.strftime('%Y%m%d').to_numpy(),
+                    'is_open': (cal_dates.dayofweek < 5).astype(int),
+                    'ts_code': np.array(ts_codes),
+                    'list_index': list_index,
+                    'open': pre_close,
+                    'high': np.maximum(close, pre_close),
+                    'low': np.minimum(close, pre_close),
+                    'close': close,
+                    'pre_close': pre_close,
+                    'change': np.round(close - pre_close, 2),
+                    'pct_chg': np.round((close / pre_close - 1) * 100, 4),
+                    'vol': vol,
+                    'amount': np.round(close * vol / 10, 3),
+                    'adj_factor': adj_factor,
+                    'total_mv': np.round(close * total_share, 2),
+                }
+        return self._panel
+
+    def _select(self, columns, ts_code=None, trade_date=None, start_date=None, end_date=None):
+        panel = self._get_panel()
+        if trade_date:
+            start_date = end_date = trade_date
+        date_mask = np.ones(len(panel['trade_date']), dtype=bool)
+        if start_date:
+            date_mask &= panel['trade_date'] >= start_date
+        if end_date:
+            date_mask &= panel['trade_date'] <= end_date
+        stock_mask = np.ones(len(panel['ts_code']), dtype=bool)
+        if ts_code:
+            stock_mask &= np.isin(panel['ts_code'], [code.strip().upper() for code in ts_code.split(',')])
+        date_index, stock_index = np.nonzero(date_mask[:, None] & stock_mask[None, :])
+        # no bar before listing
+        listed = date_index >= panel['list_index'][stock_index]
+        date_index, stock_index = date_index[listed], stock_index[listed]
+        df = pd.DataFrame({'ts_code': panel['ts_code'][stock_index], 'trade_date': panel['trade_date'][date_index]})
+        for column in columns:
+            df[column] = panel[column][date_index, stock_index]
+        # tushare returns the latest date first
+        return df.sort_values(['trade_date', 'ts_code'], ascending=[False, True])
+
+    def _daily(self, ts_code=None, trade_date=None, start_date=None, end_date=None, **kwargs):
+        columns = ['open', 'high', 'low', 'close', 'pre_close', 'change', 'pct_chg', 'vol', 'amount']
+        return self._select(columns, ts_code, trade_date, start_date, end_date)
+
+    def _adj_factor(self, ts_code=None, trade_date=None, start_date=None, end_date=None, **kwargs):
+        return self._select(['adj_factor'], ts_code, trade_date, start_date, end_date)
+
+    def _daily_basic(self, ts_code=None, trade_date=None, start_date=None, end_date=None, **kwargs):
+        return self._select(['total_mv'], ts_code, trade_date, start_date, end_date)
+
+    def _trade_cal(self, start_date=None, end_date=None, **kwargs):
+        panel = self._get_panel()
+        df = pd.DataFrame({'exchange': 'SSE', 'cal_date': panel['cal_date'], 'is_open': panel['is_open']})
+        if start_date:
+            df = df[df['cal_date'] >= start_date]
+        if end_date:
+            df = df[df['cal_date'] <= end_date]
+        return df
+
+    def _stock_basic(self, list_status='L', **kwargs):
+        panel = self._get_panel()
+        n_stock = len(panel['ts_code'])
+        # every 20th stock is delisted, every 50th is pending
+        status = np.where(np.arange(n_stock) % 20 == 19, 'D', np.where(np.arange(n_stock) % 50 == 49, 'P', 'L'))
+        df = pd.DataFrame({
+            'ts_code': panel['ts_code'],
+            'symbol': [code.split('.')[0] for code in panel['ts_code']],
+            'name': [f"股票{i}" for i in range(n_stock)],
+            'area': '深圳',
+            'industry': '软件服务',
+            'list_date': panel['trade_date'][panel['list_index']],
+            'market': '主板',
+            'delist_date': np.where(status == 'D', panel['trade_date'][-1], None),
+            'list_status': status,
+        })
+        return df[df['list_status'] == list_status]
+
+    def _namechange(self, ts_code=None, start_date=None, **kwargs):
+        panel = self._get_panel()
+        rows = list()
+        for i, code in enumerate(panel['ts_code']):
+            if ts_code and code != ts_code.upper():
+                continue
+            list_date = panel['trade_date'][panel['list_index'][i]]
+            if i % 10 == 3:
+                # one ST interval in the middle of its history
+                st_start = panel['trade_date'][panel['list_index'][i] + 250]
+                st_end = panel['trade_date'][panel['list_index'][i] + 500]
+                rows.append([code, f"ST股票{i}", st_start, st_end, st_start, 'ST'])
+                rows.append([code, f"股票{i}", list_date, st_start, list_date, '其他'])
+                rows.append([code, f"股票{i}", st_end, None, st_end, '撤销ST'])
+            else:
+                rows.append([code, f"股票{i}", list_date, None, list_date, '其他'])
+        df = pd.DataFrame(rows, columns=['ts_code', 'name', 'start_date', 'end_date', 'ann_date', 'change_reason'])
+        if start_date:
+            df = df[df['ann_date'] >= start_date]
+        return df
+
+    def _shibor(self, start_date=None, end_date=None, **kwargs):
+        panel = self._get_panel()
+        dates = panel['trade_date'][::-1]
+        if start_date:
+            dates = dates[dates >= start_date]
+        if end_date:
+            dates = dates[dates <= end_date]
+        base = 2 + np.sin(pd.to_datetime(dates).dayofyear.to_numpy() / 365 * 2 * np.pi)
+        df = pd.DataFrame({'date': dates})
+        for i, tenor in enumerate(['on', '1w', '2w', '1m', '3m', '6m', '9m', '1y']):
+            df[tenor] = np.round(base + 0.1 * i, 4)
+        return df
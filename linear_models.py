@@ -10,7 +10,9 @@ import statsmodels.api as sm
 import matplotlib.pyplot as plt
 from scipy.stats import spearmanr, ttest_1samp
 from helper import *
-from factor_processing import gen_factor
+from panel_kernel import to_panel, compress_outliers, zscore
+from storage import read_table
+from universe import in_universe
 
 __PATH_FILE = os.path.dirname(__file__)
 _ConfigFolder = 'Config'
@@ -23,22 +25,26 @@ config = get_config(__PATH_FILE, _ConfigFolder, _ConfigFile)
 sns.set(style='darkgrid')
 
 
-def no_zero_factor(df_cross_section, transform=True, z=True, method='std'):
-    target_column = df_cross_section.columns.tolist()[-1]
-    df_cross_section.dropna(axis=0, inplace=True)
-    df_copy = df_cross_section.copy()
-    df_copy = df_copy[~df_cross_section[target_column].isin([0])]  # only select non-zero value
-    df_factor_transform = gen_factor(df_copy[['symbol', 'session_end'] + [target_column]], transform=transform, z=z,
-                                     method=method)
+def no_zero_factor(df_factor, columns_factor, transform=True, z=True, method='std'):
+    """
+    transform non-zero values of every factor in every cross section at once, zero and missing values are excluded
+    :return: dataframe, columns symbol, session_end and {factor}_Trans, nan for excluded values
+    """
+    panel, (date_index, stock_index) = to_panel(df_factor, 'session_end', 'symbol', columns_factor)
+    panel[panel == 0] = np.nan  # only select non-zero value
+    if transform:
+        panel = compress_outliers(panel, method=method)
+        if z:
+            panel = zscore(panel)
+    df_factor_transform = df_factor[['symbol', 'session_end']].copy()
+    df_factor_transform[[f'{column}_Trans' for column in columns_factor]] = panel[date_index, stock_index]
 
     return df_factor_transform
 
 
 @func_timer
 def modeling(df_exess_return, df_factor, model_type='ols', transform_method='std', save=True):
-    columns_factor = df_factor.columns.tolist()
-    columns_factor.remove('symbol')
-    columns_factor.remove('session_end')
+    columns_factor = [column for column in df_factor.columns if column not in ('symbol', 'entity_id', 'session_end')]
     columns_er = df_exess_return.columns.tolist()
     columns_er = [column for column in columns_er if 'er_' in column]
     emit_log(config, _Script,
@@ -51,6 +57,7 @@ def modeling(df_exess_return, df_factor, model_type='ols', transform_method='std
     df_tvalue = pd.DataFrame(columns=df_columns)
     df_factor_loading = pd.DataFrame(columns=df_columns)
     df_ic = pd.DataFrame(columns=df_columns)
+    df_factor_transform = no_zero_factor(df_factor, columns_factor, method=transform_method)
     for column_factor in columns_factor:
         df_tvalue_tmp1 = pd.DataFrame(columns=df_columns)
         df_factor_loading_tmp1 = pd.DataFrame(columns=[column_factor, 'er', 'session_end'])
@@ -75,7 +82,8 @@ def modeling(df_exess_return, df_factor, model_type='ols', transform_method='std
                     ['symbol', 'session_end'] + [column_factor]]
                 if df_factor_cross_section[column_factor].isnull().all():
                     continue
-                df_factor_cross_section_transform = no_zero_factor(df_factor_cross_section, method=transform_method)
+                df_factor_cross_section_transform = df_factor_transform[df_factor_transform['session_end'] == date][
+                    ['symbol', f'{column_factor}_Trans']].dropna()
                 df_factor_cross_section_transform.set_index('symbol', inplace=True)
                 df_cross_section_transform = df_factor_cross_section_transform.join(df_er_cross_section)
                 df_cross_section = df_cross_section_transform[
@@ -230,12 +238,13 @@ def visualize_rgm(df_cross_section, column_factor, params):
 
 def main():
     emit_log(config, _Script, f"Program starts...")
-    # read factor data
-    df_factor = pd.read_csv(os.path.join(__PATH_FILE, _OutputFolder, 'factor.csv'),
-                            dtype={'symbol': str, 'session_end': str})
-    # read excess return
-    df_er = pd.read_csv(os.path.join(__PATH_FILE, _OutputFolder, 'excess_return.csv'),
-                        dtype={'symbol': str, 'session_date': str})
+    # read factor data, factor columns are symbol, entity_id, session_end, PAT_* and EFF_*
+    df_factor = read_table('factor')
+    # cross sections of stocks in the tradable universe only
+    df_factor = df_factor[in_universe(df_factor['session_end'], df_factor['symbol'])]
+    # read excess return of sessions with factor data only
+    df_er = read_table('excess_return', start_date=df_factor['session_end'].min(),
+                       end_date=df_factor['session_end'].max())
     # start modeling
     # model_type_list = ['OLS', 'WLS', 'RLM']
     model_type_list = ['RLM']
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+    cross-sectional transforms of a whole factor panel in one call
+    a panel is a float array of dates x stocks (x factors), nan for missing values, every transform works along the
+    stock axis for every date (and factor) at once: std/mad outlier compression, quantile winsorization, min-max
+    normalization, ranking and z-score
+"""
+__auth__ = 'Chen Chen'
+
+import warnings
+import numpy as np
+import pandas as pd
+from helper import *
+
+__PATH_FILE = os.path.dirname(__file__)
+_ConfigFolder = 'Config'
+_ConfigFile = 'config.json'
+_Script = os.path.basename(__file__).rstrip('.py')
+config = get_config(__PATH_FILE, _ConfigFolder, _ConfigFile)
+_MAD_CONSTANT = 1.4816
+
+
+def to_panel(df, date_column, stock_column, columns):
+    """
+    :param df: long dataframe, one row per date and stock
+    :param date_column: e.g. session_end
+    :param stock_column: e.g. symbol
+    :param columns: factor columns
+    :return: panel, dates x stocks x factors, and (date index, stock index) of rows of df, so that
+             panel[date_index, stock_index] is aligned with df[columns]
+    :raise ValueError: if a row has no date or stock, or a date and stock has more than one row
+    """
+    date_index, dates = pd.factorize(df[date_column], sort=True)
+    stock_index, stocks = pd.factorize(df[stock_column], sort=True)
+    # factorize codes missing values -1, which would index the last date or stock
+    n_missing = np.sum((date_index < 0) | (stock_index < 0))
+    if n_missing > 0:
+        raise ValueError(f"{n_missing} rows without {date_column} or {stock_column}.")
+    n_duplicated = len(df) - len(np.unique(date_index.astype('int64') * len(stocks) + stock_index))
+    if n_duplicated > 0:
+        raise ValueError(f"{n_duplicated} duplicated rows of {date_column} and {stock_column}.")
+    panel = np.full((len(dates), len(stocks), len(columns)), np.nan)
+    panel[date_index, stock_index] = df[columns].to_numpy(dtype='float64')
+
+    return panel, (date_index, stock_index)
+
+
+def _stock_last(panel):
+    # dates x stocks (x factors) -> dates (x factors) x stocks
+    return np.moveaxis(np.asarray(panel, dtype='float64'), 1, -1)
+
+
+def _stock_back(x):
+    return np.moveaxis(x, -1, 1)
+
+
+def _nan_stat(func, x, **kwargs):
+    # statistics of all nan cross sections are nan, without warning
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return func(x, axis=-1, keepdims=True, **kwargs)
+
+
+def compress_outliers(panel, method='std'):
+    """
+    transform outliers greater than 3 std (or 3 mad) between 3 and 5 std (mad), max/min are mapped to 5 std (mad)
+    :param panel: dates x stocks (x factors)
+    :param method: std or mad
+    :return: transformed panel, same shape
+    """
+    if method not in ('std', 'mad'):
+        raise ValueError("Invalid method!")
+    x = _stock_last(panel)
+    if method == 'std':
+        # TODO could try smaller std, e.g. 2-3 std
+        center = _nan_stat(np.nanmean, x)
+        scale = _nan_stat(np.nanstd, x)
+    else:
+        center = _nan_stat(np.nanmedian, x)
+        scale = _MAD_CONSTANT * _nan_stat(np.nanmedian, np.abs(x - center))
+    _min = _nan_stat(np.nanmin, x)
+    _max = _nan_stat(np.nanmax, x)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        upper = center + 3 * scale + 2 * scale * (x - center - 3 * scale) / (_max - center - 3 * scale)
+        lower = center - 3 * scale - 2 * scale * (x - (center - 3 * scale)) / (_min - (center - 3 * scale))
+        x = np.where(x > center + 3 * scale, upper, np.where(x < center - 3 * scale, lower, x))
+
+    return _stock_back(x)
+
+
+def winsorize(panel, left=0.01, right=0.99):
+    """
+    clip values to the left/right quantiles (linear interpolation) of the cross section
+    """
+    x = _stock_last(panel)
+    q = _nan_stat(np.nanquantile, x, q=[left, right])
+    # quantile axis comes first
+    return _stock_back(np.clip(x, q[0], q[1]))
+
+
+def min_max(panel):
+    """
+    normalize the cross section into [0, 1]
+    """
+    x = _stock_last(panel)
+    _min = _nan_stat(np.nanmin, x)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return _stock_back((x - _min) / (_nan_stat(np.nanmax, x) - _min))
+
+
+def rank(panel, pct=False):
+    """
+    rank in the cross section from 1, ties get the average rank, nan stays nan
+    :param pct: divide ranks by the number of valid values of the cross section
+    """
+    x = _stock_last(panel)
+    n = x.shape[-1]
+    # nan is sorted last
+    order = np.argsort(x, axis=-1, kind='mergesort')
+    x_sorted = np.take_along_axis(x, order, axis=-1)
+    position = np.broadcast_to(np.arange(1, n + 1), x.shape)
+    is_first = np.ones(x.shape, dtype=bool)
+    is_first[..., 1:] = x_sorted[..., 1:] != x_sorted[..., :-1]
+    is_last = np.ones(x.shape, dtype=bool)
+    is_last[..., :-1] = is_first[..., 1:]
+    # first and last position of the tie group of every value
+    first = np.maximum.accumulate(np.where(is_first, position, 0), axis=-1)
+    last = np.flip(np.minimum.accumulate(np.flip(np.where(is_last, position, n + 1), axis=-1), axis=-1), axis=-1)
+    rank_sorted = np.where(np.isnan(x_sorted), np.nan, (first + last) / 2)
+    ranks = np.empty(x.shape)
+    np.put_along_axis(ranks, order, rank_sorted, axis=-1)
+    if pct:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ranks = ranks / np.sum(~np.isnan(x), axis=-1, keepdims=True)
+
+    return _stock_back(ranks)
+
+
+def zscore(panel, pool_factors=False):
+    """
+    standardize the cross section with mean and population std
+    :param pool_factors: mean and std of all factors of a date together instead of each factor, as gen_factor does
+    """
+    if pool_factors:
+        x = np.asarray(panel, dtype='float64')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            mean = np.nanmean(x, axis=tuple(range(1, x.ndim)), keepdims=True)
+            std = np.nanstd(x, axis=tuple(range(1, x.ndim)), keepdims=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (x - mean) / std
+    x = _stock_last(panel)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return _stock_back((x - _nan_stat(np.nanmean, x)) / _nan_stat(np.nanstd, x))
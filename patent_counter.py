@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+    patent counting engine shared by patent_count_in_session and data_factor
+    patents are counted once into a company (entity_id) x publication month panel, the count of every company in every
+    session of every period is a difference of two columns of its cumulative sum over months
+    bbd_qyxx_id of zhuanli.csv is read as categorical, only its categories are looked up in the entity dictionary and
+    rows get entity_id by indexing with the category codes, the output carries entity_id and symbol
+    sessions are whole months (first to last trade date of a month), so the panel counts patents published on
+    non-trade days at the boundary months into the session as well
+    zhuanli.csv is read in chunks of patent_chunk_size rows (config.json), each chunk is folded into the panel and
+    dropped, memory is bounded by the chunk and the panel, not by the size of the file
+    patent_type is classified once into a bitmask, one panel per bitmask is kept in Output/PatentState/patent_type/,
+    the counts of any patent_type variant (config.json) are sums of the panels, without reading zhuanli.csv again as
+    long as it is unchanged; run with --update to recount only the patents published in and after the last month of
+    the panels, which may have been delivered partly, and to write only the sessions they change
+"""
+__auth__ = 'Chen Chen'
+
+import sys
+import hashlib
+import numpy as np
+import pandas as pd
+from storage import save_table, append_table, read_table, exists_table
+from entity import get_entity_dict
+from helper import *
+
+__PATH_FILE = os.path.dirname(__file__)
+_ConfigFolder = 'Config'
+_ConfigFile = 'config.json'
+_InputFolder = 'Input'
+_OutputFolder = 'Output'
+_StateFolder = 'PatentState'
+_TypeStateFolder = 'patent_type'
+_ManifestFile = 'manifest.json'
+_Script = os.path.basename(__file__).rstrip('.py')
+config = get_config(__PATH_FILE, _ConfigFolder, _ConfigFile)
+_UPDATE = '--update' in sys.argv
+_PATH_STATE = os.path.join(__PATH_FILE, _OutputFolder, _StateFolder)
+# compact dtypes of the columns read from zhuanli.csv
+_PATENT_DTYPES = {'bbd_qyxx_id': 'category', 'publidate': 'str', 'patent_type': 'category'}
+# bit of patent type in the bitmask of patent_type, and the text of patent_type it matches
+PATENT_TYPE_BITS = {'invention': 1, 'utility': 2, 'appearance': 4}
+_PATENT_TYPE_TEXT = {'invention': '发明', 'utility': '实用新型', 'appearance': '外观设计'}
+_APPLICATION_BIT = 8
+_APPLICATION_TEXT = '申请'
+# changed month of a full count, every session is changed
+_FIRST_MONTH = np.datetime64('1970-01', 'M')
+# row key of the saved panels, panels of symbols saved by older versions are counted again
+_STATE_KEY = 'entity_id'
+
+
+class MonthlyPatentCount(object):
+    """
+    dense company x month panel of patent counts
+    :param entity_ids: int32 array of entity_id of rows, sorted
+    :param first_month: datetime64[M], month of column 0
+    :param counts: int32 array, company x month
+    """
+
+    def __init__(self, entity_ids, first_month, counts):
+        self.entity_ids = np.asarray(entity_ids, dtype='int32')
+        self.first_month = np.datetime64(first_month, 'M')
+        self.counts = np.asarray(counts, dtype='int32')
+
+    @classmethod
+    def empty(cls, entity_ids=()):
+        """
+        :param entity_ids: companies kept in the panel even without any patent
+        """
+        entity_ids = np.unique(np.asarray(entity_ids, dtype='int32'))
+        return cls(entity_ids, np.datetime64('1970-01', 'M'), np.zeros((len(entity_ids), 0)))
+
+    @classmethod
+    def from_patent(cls, df_patent):
+        """
+        :param df_patent: columns entity_id and publidate, publidate is missing for companies without patent
+        """
+        entity_ids, entity_code = np.unique(df_patent['entity_id'].to_numpy(dtype='int32'), return_inverse=True)
+        publimonth = pd.to_datetime(df_patent['publidate']).values.astype('datetime64[M]')
+        has_date = ~np.isnat(publimonth)
+        if not has_date.any():
+            return cls.empty(entity_ids)
+        first_month = publimonth[has_date].min()
+        month_offset = (publimonth[has_date] - first_month).astype('int64')
+        n_month = int(month_offset.max()) + 1
+        # flat index of company x month, counted in one bincount
+        counts = np.bincount(entity_code[has_date] * n_month + month_offset, minlength=len(entity_ids) * n_month)
+
+        return cls(entity_ids, first_month, counts.reshape(len(entity_ids), n_month))
+
+    @classmethod
+    def load(cls, path_file):
+        with np.load(path_file) as state:
+            return cls(state['entity_ids'], state['first_month'], state['counts'])
+
+    def save(self, path_file):
+        os.makedirs(os.path.dirname(path_file), exist_ok=True)
+        # write to a temporary file first, a crash never leaves a broken state
+        with open(f"{path_file}.tmp", 'wb') as f:
+            np.savez(f, entity_ids=self.entity_ids, first_month=self.first_month, counts=self.counts)
+        os.replace(f"{path_file}.tmp", path_file)
+
+    def last_month(self):
+        """
+        :return: datetime64[M] of the last month of the panel, None if empty
+        """
+        return self.first_month + self.counts.shape[1] - 1 if self.counts.shape[1] > 0 else None
+
+    def before(self, month):
+        """
+        :param month: datetime64[M]
+        :return: MonthlyPatentCount of the months before month
+        """
+        n_month = int(np.clip((np.datetime64(month, 'M') - self.first_month).astype('int64'), 0,
+                              self.counts.shape[1]))
+        return MonthlyPatentCount(self.entity_ids, self.first_month, self.counts[:, :n_month])
+
+    def add(self, other):
+        """
+        :param other: MonthlyPatentCount
+        :return: MonthlyPatentCount of the summed counts, on the union of companies and months of both panels
+        """
+        panels = [panel for panel in (self, other) if panel.counts.shape[1] > 0]
+        entity_ids = np.union1d(self.entity_ids, other.entity_ids)
+        if not panels:
+            return MonthlyPatentCount.empty(entity_ids)
+        first_month = min(panel.first_month for panel in panels)
+        n_month = int(max((panel.first_month - first_month).astype('int64') + panel.counts.shape[1]
+                          for panel in panels))
+        counts = np.zeros((len(entity_ids), n_month), dtype='int32')
+        for panel in panels:
+            month_offset = int((panel.first_month - first_month).astype('int64'))
+            counts[np.searchsorted(entity_ids, panel.entity_ids), month_offset:month_offset + panel.counts.shape[1]] \
+                += panel.counts
+
+        return MonthlyPatentCount(entity_ids, first_month, counts)
+
+    def window_count(self, start_dates, end_dates):
+        """
+        patent count of every company in months of start_dates to months of end_dates (inclusive), by cumulative sum
+        differencing
+        :param start_dates: dates (YYYYMMDD) of the first month of the windows
+        :param end_dates: dates (YYYYMMDD) of the last month of the windows
+        :return: int32 array, company x window
+        """
+        n_month = self.counts.shape[1]
+        # cumsum[:, j] is the count of months before j
+        cumsum = np.zeros((len(self.entity_ids), n_month + 1), dtype='int64')
+        np.cumsum(self.counts, axis=1, out=cumsum[:, 1:])
+        start_index = (_to_month(start_dates) - self.first_month).astype('int64')
+        end_index = (_to_month(end_dates) - self.first_month).astype('int64') + 1
+
+        return (cumsum[:, np.clip(end_index, 0, n_month)] - cumsum[:, np.clip(start_index, 0, n_month)]).astype(
+            'int32')
+
+
+def iter_patent_chunk(columns=('publidate',), chunk_size=None):
+    """
+    stream zhuanli.csv from data warehouse in chunks, joined to entity_id of the listed companies by the entity
+    dictionary
+    :param columns: columns of zhuanli.csv besides bbd_qyxx_id
+    :param chunk_size: rows per chunk, default is patent_chunk_size in config.json
+    :return: generator of dataframes, columns entity_id and columns, patents of unlisted companies are dropped
+    """
+    usecols = ['bbd_qyxx_id'] + list(columns)
+    reader = pd.read_csv(os.path.join(__PATH_FILE, _InputFolder, 'zhuanli.csv'), usecols=usecols,
+                         dtype={column: _PATENT_DTYPES.get(column, 'str') for column in usecols},
+                         chunksize=int(chunk_size or config.get('patent_chunk_size')))
+    entity_dict = get_entity_dict()
+    for i, df_chunk in enumerate(reader):
+        # bbd_qyxx_id is categorical, only distinct ids of the chunk are looked up
+        entity_id = entity_dict.encode(df_chunk['bbd_qyxx_id'], 'bbd_qyxx_id')
+        df_chunk = df_chunk[entity_id >= 0].assign(entity_id=entity_id[entity_id >= 0])
+        emit_log(config, _Script, f"zhuanli.csv chunk {i}: {len(df_chunk)} patents of listed companies.")
+        yield df_chunk[['entity_id'] + list(columns)]
+
+
+def classify_patent_type(patent_type):
+    """
+    :param patent_type: categorical series of patent_type in zhuanli.csv, e.g. 发明授权, 实用新型
+    :return: uint8 array, bitmask of PATENT_TYPE_BITS and the application bit, 0 for missing patent_type
+    """
+    # match the text of every category once instead of every row, the last slot is for missing (code -1)
+    categories = pd.Series(patent_type.cat.categories.astype(str))
+    category_bits = np.zeros(len(categories) + 1, dtype='uint8')
+    for p_type, bit in PATENT_TYPE_BITS.items():
+        category_bits[:-1] |= categories.str.contains(_PATENT_TYPE_TEXT[p_type]).to_numpy().astype('uint8') * bit
+    category_bits[:-1] |= categories.str.contains(_APPLICATION_TEXT).to_numpy().astype('uint8') * _APPLICATION_BIT
+
+    return category_bits[patent_type.cat.codes.to_numpy()]
+
+
+def patent_type_selector(p_type):
+    """
+    :param p_type: list of patent types, keys of PATENT_TYPE_BITS or 'all'
+    :return: function of a patent type bitmask, True if patents of the bitmask are counted: a patent is counted once
+             if it is of any type in p_type and is not an application; with 'all' every patent is counted
+    """
+    for item in p_type:
+        if item not in PATENT_TYPE_BITS.keys() and item != 'all':
+            raise ValueError("Invalid patent type!")
+    type_mask = sum(PATENT_TYPE_BITS[item] for item in set(p_type) if item != 'all')
+
+    def is_selected(type_bits):
+        return 'all' in p_type or ((type_bits & _APPLICATION_BIT) == 0 and (type_bits & type_mask) != 0)
+
+    return is_selected
+
+
+@func_timer
+def read_typed_patent_count(from_month=None):
+    """
+    :param from_month: datetime64[M], only patents published in or after the month are counted, default all
+    :return: dict, patent type bitmask -> MonthlyPatentCount of the patents of the bitmask in zhuanli.csv
+    """
+    typed_count = dict()
+    for df_chunk in iter_patent_chunk(columns=['publidate', 'patent_type']):
+        if from_month is not None:
+            df_chunk = df_chunk[pd.to_datetime(df_chunk['publidate']).values.astype('datetime64[M]') >= from_month]
+        type_bits = classify_patent_type(df_chunk['patent_type'])
+        for bits in np.unique(type_bits):
+            monthly_count = MonthlyPatentCount.from_patent(df_chunk[type_bits == bits])
+            typed_count[int(bits)] = typed_count.get(int(bits), MonthlyPatentCount.empty()).add(monthly_count)
+
+    return typed_count
+
+
+def combine_patent_count(typed_count, p_type=('all',), entity_ids=()):
+    """
+    :param typed_count: output of read_typed_patent_count
+    :param p_type: list of patent types, see patent_type_selector
+    :param entity_ids: companies kept in the panel even without patent
+    :return: MonthlyPatentCount of the patents of p_type
+    """
+    is_selected = patent_type_selector(p_type)
+    monthly_count = MonthlyPatentCount.empty(entity_ids)
+    for type_bits, monthly_count_type in typed_count.items():
+        if is_selected(type_bits):
+            monthly_count = monthly_count.add(monthly_count_type)
+
+    return monthly_count
+
+
+def _get_source_stamp():
+    # zhuanli.csv and the companies it is joined to, the state is only valid for the same source
+    path_source = os.path.join(__PATH_FILE, _InputFolder, 'zhuanli.csv')
+    df_company = get_entity_dict().get_company()
+    company_hash = hashlib.sha1(pd.util.hash_pandas_object(df_company, index=False).to_numpy().tobytes()).hexdigest()
+    return {'mtime': os.path.getmtime(path_source), 'size': os.path.getsize(path_source), 'company': company_hash}
+
+
+def _save_typed_state(typed_count, source_stamp):
+    path_folder = os.path.join(_PATH_STATE, _TypeStateFolder)
+    for type_bits, monthly_count in typed_count.items():
+        monthly_count.save(os.path.join(path_folder, f"{type_bits}.npz"))
+    path_manifest = os.path.join(path_folder, _ManifestFile)
+    with open(f"{path_manifest}.tmp", 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'source': source_stamp, 'key': _STATE_KEY, 'type_bits': sorted(typed_count.keys())}))
+    os.replace(f"{path_manifest}.tmp", path_manifest)
+
+
+@func_timer
+def update_typed_patent_count(update=None):
+    """
+    monthly panels of every patent type bitmask, kept in Output/PatentState/patent_type/ and shared by all outputs
+    the panels are reused as long as zhuanli.csv and the companies are unchanged; with --update a changed zhuanli.csv
+    is recounted from the last month of the panels, otherwise it is counted again in full
+    :param update: default is --update in command line
+    :return: dict of type bitmask -> MonthlyPatentCount, and datetime64[M] of the first month whose counts changed,
+             None if unchanged
+    """
+    update = _UPDATE if update is None else update
+    path_folder = os.path.join(_PATH_STATE, _TypeStateFolder)
+    path_manifest = os.path.join(path_folder, _ManifestFile)
+    source_stamp = _get_source_stamp()
+    manifest = dict()
+    if os.path.exists(path_manifest):
+        with open(path_manifest, encoding='utf-8') as f:
+            manifest = json.loads(f.read())
+    if manifest.get('key') == _STATE_KEY:
+        typed_count = {type_bits: MonthlyPatentCount.load(os.path.join(path_folder, f"{type_bits}.npz"))
+                       for type_bits in manifest['type_bits']}
+        if manifest['source'] == source_stamp:
+            emit_log(config, _Script, f"zhuanli.csv unchanged, patent counts of {len(typed_count)} types reused.")
+            return typed_count, None
+        last_month_list = [m.last_month() for m in typed_count.values() if m.last_month() is not None]
+        if update and manifest['source']['company'] == source_stamp['company'] and last_month_list:
+            # the last month is replaced, patents of the month may have arrived late
+            last_month = max(last_month_list)
+            emit_log(config, _Script, f"recount patents published in and after {last_month}.")
+            typed_count = {type_bits: m.before(last_month) for type_bits, m in typed_count.items()}
+            for type_bits, monthly_count in read_typed_patent_count(from_month=last_month).items():
+                typed_count[type_bits] = typed_count.get(type_bits, MonthlyPatentCount.empty()).add(monthly_count)
+            _save_typed_state(typed_count, source_stamp)
+            return typed_count, last_month
+    typed_count = read_typed_patent_count()
+    _save_typed_state(typed_count, source_stamp)
+
+    return typed_count, _FIRST_MONTH
+
+
+@func_timer
+def run_patent_count(df_session, table_name, p_type=('all',), entity_ids=(), update=None):
+    """
+    count patents of p_type in every session into table_name, from the monthly panels of update_typed_patent_count
+    :param df_session: output of trade_calendar.get_session_table
+    :param table_name: output table
+    :param p_type: list of patent types, see patent_type_selector
+    :param entity_ids: companies kept in the output even without patent
+    :param update: write only the sessions changed since the last run, default is --update in command line
+    """
+    update = _UPDATE if update is None else update
+    typed_count, changed_month = update_typed_patent_count(update)
+    monthly_count = combine_patent_count(typed_count, p_type=p_type, entity_ids=entity_ids)
+    # a full count rewrites the table
+    if update and exists_table(table_name) and changed_month != _FIRST_MONTH:
+        # sessions changed by the recounted months, and sessions not written yet
+        session_end_saved = read_table(table_name, columns=['session_end'])['session_end']
+        mask = (df_session['session_end'] > session_end_saved.max()).to_numpy()
+        if changed_month is not None:
+            mask |= _to_month(df_session['session_end'].to_numpy()) >= changed_month
+        if mask.any():
+            df_patent_count_session = count_patent_for_session(monthly_count, df_session[mask])
+            append_table(df_patent_count_session, table_name, keys=['entity_id', 'session_end'])
+        emit_log(config, _Script, f"{table_name}: {mask.sum()} sessions updated.")
+    else:
+        count_patent_for_session(monthly_count, df_session, table_name=table_name)
+
+
+def _to_month(dates):
+    return pd.to_datetime(pd.Series(dates), format='%Y%m%d').values.astype('datetime64[M]')
+
+
+@func_timer
+def count_patent_for_session(monthly_count, df_session, table_name=''):
+    """
+    :param monthly_count: MonthlyPatentCount
+    :param df_session: output of trade_calendar.get_session_table
+    :param table_name: save to table if given
+    :return: dataframe, columns symbol, entity_id, PAT_<period> of every period, session_end; every company in every
+             session, sorted by session_end and entity_id
+    """
+    # sessions start on the first and end on the last trade date of a month, count whole months
+    count = monthly_count.window_count(df_session['session_start'].to_numpy(), df_session['session_end'].to_numpy())
+
+    # one column per period, rows of (session_end, entity_id)
+    df_count_list = list()
+    for k in pd.unique(df_session['period']):
+        mask = (df_session['period'] == k).to_numpy()
+        index = pd.MultiIndex.from_product([df_session.loc[mask, 'session_end'], monthly_count.entity_ids],
+                                           names=['session_end', 'entity_id'])
+        df_count_list.append(pd.DataFrame({f'PAT_{k}': count[:, mask].T.ravel()}, index=index))
+    df_patent_count_session = pd.concat(df_count_list, axis=1).reset_index()
+    df_patent_count_session['symbol'] = get_entity_dict().decode(df_patent_count_session['entity_id'])
+    # adjust column order
+    fields = ['symbol', 'entity_id'] + [f'PAT_{k}' for k in pd.unique(df_session['period'])] + ['session_end']
+    df_patent_count_session = df_patent_count_session[fields]
+    emit_log(config, _Script, f"{len(monthly_count.entity_ids)} companies, {len(df_session)} sessions counted.")
+
+    # whether save to table
+    if table_name:
+        save_table(df_patent_count_session, table_name)
+        emit_log(config, _Script, f"Table {table_name} saved.")
+
+    return df_patent_count_session
@@ -6,7 +6,9 @@ import sys
 import numpy as np
 import pandas as pd
 from dateutil.relativedelta import relativedelta
-from patent_count_in_session import get_session_list
+from trade_calendar import get_session_table
+from storage import save_table
+from entity import get_entity_dict
 from helper import *
 
 __PATH_FILE = os.path.dirname(__file__)
@@ -16,40 +18,99 @@ _InputFolder = 'Input'
 _OutputFolder = 'Output'
 _Script = os.path.basename(__file__).rstrip('.py')
 config = get_config(__PATH_FILE, _ConfigFolder, _ConfigFile)
+_PATH_RD_MATRIX = os.path.join(__PATH_FILE, _OutputFolder, 'RdCost')
+_RD_DTYPES = {'bbd_qyxx_id': 'category', 'report_date': 'str', 'r_and_d_cost': 'float64', 'ann_date': 'str'}
+# announcement date column of yanfa.csv, the first one found is read as ann_date
+_RD_ANN_DATE_COLUMNS = ['ann_date', 'announcement_date', 'publish_date']
+# statutory disclosure deadline, months after the report month end: Q1 by 04/30, H1 by 08/31, Q3 by 10/31 and
+# annual report by 04/30 of next year
+_RD_DISCLOSURE_LAG_MONTHS = {3: 1, 6: 2, 9: 1, 12: 4}
 
 
 @func_timer
-def process_rd_data():
-    # read raw data of r&d and company
-    df_rd = pd.read_csv(os.path.join(__PATH_FILE, _InputFolder, 'yanfa.csv'),
-                        usecols=['bbd_qyxx_id', 'report_date', 'r_and_d_cost'])
-    df_company = pd.read_csv(os.path.join(__PATH_FILE, _InputFolder, 'company_list_withid.csv'),
-                             usecols=['symbol', 'bbd_qyxx_id'], dtype={'symbol': str})
-    # merge data with bbd_qyxx_id
-    df_rd = pd.merge(left=df_company, right=df_rd, how='left', on='bbd_qyxx_id')
+def read_rd_data():
+    """
+    :return: yanfa.csv from data warehouse, r_and_d_cost is float64 and '--' is nan, with column ann_date if yanfa.csv
+             has an announcement date
+    """
+    path_rd = os.path.join(__PATH_FILE, _InputFolder, 'yanfa.csv')
+    columns = pd.read_csv(path_rd, nrows=0).columns
+    usecols = ['bbd_qyxx_id', 'report_date', 'r_and_d_cost']
+    column_ann_date = next((column for column in _RD_ANN_DATE_COLUMNS if column in columns), None)
+    if column_ann_date is not None:
+        usecols.append(column_ann_date)
+    df_rd = pd.read_csv(path_rd, usecols=usecols, na_values=['--'],
+                        dtype={column: _RD_DTYPES.get(column, _RD_DTYPES['ann_date']) for column in usecols})
+
+    return df_rd.rename(columns={column_ann_date: 'ann_date'}) if column_ann_date is not None else df_rd
+
+
+def get_disclosure_date(report_date):
+    """
+    :param report_date: datetime series of report period end, e.g. 2019-06-30
+    :return: datetime series of the statutory disclosure deadline of the report, e.g. 2019-08-31
+    """
+    lag_months = report_date.dt.month.map(_RD_DISCLOSURE_LAG_MONTHS).fillna(3).astype(int).to_numpy()
+    deadline_month = report_date.to_numpy().astype('datetime64[M]') + lag_months
+
+    return pd.Series((deadline_month + 1).astype('datetime64[D]') - 1, index=report_date.index)
+
+
+@func_timer
+def clean_rd_data():
+    """
+    :return: dataframe of r&d records, columns entity_id, symbol, bbd_qyxx_id, report_date, r_and_d_cost (year to
+             date) and ann_date, ann_date falls back to the statutory disclosure deadline if yanfa.csv has no
+             announcement date
+    """
+    # read raw data of r&d
+    df_rd = read_rd_data()
+    # join to companies by entity_id, bbd_qyxx_id is categorical and only its distinct ids are looked up
+    entity_dict = get_entity_dict()
+    entity_id = entity_dict.encode(df_rd['bbd_qyxx_id'], 'bbd_qyxx_id')
+    df_rd = df_rd[entity_id >= 0].drop(columns='bbd_qyxx_id')
+    entity_id = entity_id[entity_id >= 0]
+    df_rd.insert(0, 'entity_id', entity_id)
+    df_rd.insert(1, 'symbol', entity_dict.decode(entity_id, 'symbol'))
+    df_rd.insert(2, 'bbd_qyxx_id', entity_dict.decode(entity_id, 'bbd_qyxx_id'))
     # convert date format
     df_rd['report_date'] = pd.to_datetime(df_rd['report_date'])
-    # add a new column of period
-    df_rd['quarter'] = pd.PeriodIndex(df_rd.report_date, freq='Q')
-    df_rd.drop_duplicates(inplace=True)
+    if 'ann_date' in df_rd.columns:
+        df_rd['ann_date'] = pd.to_datetime(df_rd['ann_date']).fillna(get_disclosure_date(df_rd['report_date']))
+    else:
+        df_rd['ann_date'] = get_disclosure_date(df_rd['report_date'])
+    # the same record announced again is known since the first announcement
+    df_rd = df_rd.sort_values('ann_date', kind='mergesort')
+    df_rd = df_rd.drop_duplicates(['entity_id', 'report_date', 'r_and_d_cost'])
     # remove companies with no r&d cost
-    df_rd = df_rd[df_rd['r_and_d_cost'] != '--']
+    df_rd = df_rd[df_rd['r_and_d_cost'].notnull()]
     # only select data after start date
     df_rd = df_rd[df_rd['report_date'] >= config.get('start_date')]
 
-    # somehow dirty data exist, remove companies with multiple records
-    df = df_rd.groupby(['bbd_qyxx_id', 'report_date']).count().reset_index()
-    df = df[df['r_and_d_cost'] > 1]
-    bbd_id_with_multi_records = df.bbd_qyxx_id.drop_duplicates().tolist()
-    df_rd = df_rd[~df_rd.bbd_qyxx_id.isin(bbd_id_with_multi_records)]
+    # somehow dirty data exist, remove companies with multiple records of a report date, found by hash of the key
+    key_hash = pd.util.hash_pandas_object(df_rd[['entity_id', 'report_date']], index=False)
+    entity_id_with_multi_records = df_rd.loc[key_hash.duplicated(keep=False).to_numpy(), 'entity_id'].unique()
+    df_rd = df_rd[~df_rd['entity_id'].isin(entity_id_with_multi_records)]
 
     # if r&d dataframe has very early data, only select part of data
     today = datetime.datetime.today()
     start_date = today - relativedelta(years=config.get('time_len') + 2)  # +2 for safe boundary
     df_rd = df_rd[df_rd['report_date'] >= start_date]
-    # use bbd_qyxx_id instead of company_name, otherwise the company changed name will have two records after groupby
-    df_rd_pivot = df_rd.pivot_table(index=['symbol', 'bbd_qyxx_id'], columns='quarter', values='r_and_d_cost',
-                                    aggfunc=np.sum)
+
+    return df_rd
+
+
+@func_timer
+def process_rd_data(df_rd):
+    """
+    :param df_rd: output of clean_rd_data
+    :return: company x quarter pivot of r&d cost, filled forward and backward
+    """
+    # add a new column of period
+    df_rd = df_rd.assign(quarter=pd.PeriodIndex(df_rd.report_date, freq='Q'))
+    # use entity_id instead of company_name, otherwise the company changed name will have two records after groupby
+    df_rd_pivot = df_rd.pivot_table(index=['entity_id', 'symbol', 'bbd_qyxx_id'], columns='quarter',
+                                    values='r_and_d_cost', aggfunc='sum')
 
     # TODO maybe only select companies with enough data
 
@@ -58,99 +119,216 @@ def process_rd_data():
     # backward fill nan to ensure no nan in the dataframe
     df_rd_pivot_fillna_fill_all = df_rd_pivot_fillna_ffill.fillna(method='bfill', axis=1)
 
-    return df_rd_pivot_fillna_fill_all
+    return df_rd_pivot_fillna_fill_all.astype('float64')
+
+
+def save_rd_matrix(df_rd):
+    """
+    save company x quarter r&d pivot as Output/RdCost/rd_cost_quarter.npy, with the company index and quarter columns
+    in rd_cost_quarter_label.json, so that it can be memory mapped by load_rd_matrix
+    the matrix is float64: ttm cost is a difference of year to date costs, float32 rounding of the costs is amplified
+    by the subtraction up to about 3e-5 relative error
+    """
+    os.makedirs(_PATH_RD_MATRIX, exist_ok=True)
+    np.save(os.path.join(_PATH_RD_MATRIX, 'rd_cost_quarter.npy'), df_rd.to_numpy(dtype='float64'))
+    label = {'entity_id': df_rd.index.get_level_values('entity_id').tolist(),
+             'symbol': df_rd.index.get_level_values('symbol').tolist(),
+             'bbd_qyxx_id': df_rd.index.get_level_values('bbd_qyxx_id').tolist(),
+             'quarter': [str(quarter) for quarter in df_rd.columns]}
+    with open(os.path.join(_PATH_RD_MATRIX, 'rd_cost_quarter_label.json'), 'w', encoding='utf-8') as f:
+        f.write(json.dumps(label))
+
+
+def load_rd_matrix(mmap_mode='r'):
+    """
+    :param mmap_mode: mode of np.load, 'r' maps the matrix read only without loading it, None loads it in memory
+    :return: dataframe of company x quarter r&d pivot, the same as process_rd_data
+    """
+    with open(os.path.join(_PATH_RD_MATRIX, 'rd_cost_quarter_label.json'), encoding='utf-8') as f:
+        label = json.loads(f.read())
+    matrix = np.load(os.path.join(_PATH_RD_MATRIX, 'rd_cost_quarter.npy'), mmap_mode=mmap_mode)
+    index = pd.MultiIndex.from_arrays([np.asarray(label['entity_id'], dtype='int32'), label['symbol'],
+                                       label['bbd_qyxx_id']], names=['entity_id', 'symbol', 'bbd_qyxx_id'])
+    columns = pd.PeriodIndex(label['quarter'], freq='Q', name='quarter')
+
+    return pd.DataFrame(matrix, index=index, columns=columns, copy=False)
+
+
+class RdAsOfIndex(object):
+    """
+    point-in-time index of ttm r&d cost, keyed by (company, date when the ttm is known)
+    ttm of a report quarter is r_and_d_cost(quarter) + r_and_d_cost(last year end) - r_and_d_cost(same quarter last
+    year), ttm of a year end is r_and_d_cost(year end), it is known when all of its reports are announced
+    :param df_rd: output of clean_rd_data
+    """
+
+    def __init__(self, df_rd):
+        report_date = pd.to_datetime(df_rd['report_date'])
+        quarter = (report_date.dt.year * 4 + report_date.dt.quarter - 1).to_numpy()
+        s_cost = pd.Series(df_rd['r_and_d_cost'].to_numpy(), index=[df_rd['entity_id'].to_numpy(), quarter])
+        s_ann = pd.Series(df_rd['ann_date'].to_numpy().astype('datetime64[D]'), index=s_cost.index)
+        s_cost, s_ann = s_cost[~s_cost.index.duplicated()], s_ann[~s_ann.index.duplicated()]
+        entity_id = s_cost.index.get_level_values(0).to_numpy()
+        quarter = s_cost.index.get_level_values(1).to_numpy()
+        # reports of last year end and of the same quarter last year, looked up for all records at once
+        index_last_year = pd.MultiIndex.from_arrays([entity_id, quarter // 4 * 4 - 1])
+        index_last_in_last_year = pd.MultiIndex.from_arrays([entity_id, quarter - 4])
+        is_year_end = quarter % 4 == 3
+        ttm = np.where(is_year_end, s_cost.to_numpy(),
+                       s_cost.to_numpy() + s_cost.reindex(index_last_year).to_numpy() -
+                       s_cost.reindex(index_last_in_last_year).to_numpy())
+        known_date = np.where(is_year_end, s_ann.to_numpy(),
+                              np.maximum.reduce([s_ann.to_numpy(), s_ann.reindex(index_last_year).to_numpy(),
+                                                 s_ann.reindex(index_last_in_last_year).to_numpy()]))
+        valid = ~np.isnan(ttm)
+        self.entity_ids, entity_code = np.unique(entity_id[valid].astype('int32'), return_inverse=True)
+        # sorted by company, known date and quarter, the last row on or before a date is the latest known ttm
+        order = np.lexsort((quarter[valid], known_date[valid], entity_code))
+        self._entity_code = entity_code[order].astype('int64')
+        self._known_day = known_date[valid][order].astype('datetime64[D]').astype('int64')
+        self._quarter = quarter[valid][order]
+        self._ttm = ttm[valid][order]
+
+    def asof(self, dates, report_quarters=None):
+        """
+        latest known ttm r&d cost of every company as of every date, in one searchsorted batch
+        :param dates: dates, YYYYMMDD
+        :param report_quarters: quarters of reports used, e.g. (2, 4) for half year and annual reports, default all
+        :return: float64 array, company (self.entity_ids) x date, nan if nothing is known yet
+        """
+        mask = np.ones(len(self._ttm), dtype=bool) if report_quarters is None else \
+            np.isin(self._quarter % 4 + 1, report_quarters)
+        entity_code, known_day, ttm = self._entity_code[mask], self._known_day[mask], self._ttm[mask]
+        if len(ttm) == 0:
+            return np.full((len(self.entity_ids), len(dates)), np.nan)
+        query_day = pd.to_datetime(pd.Series(dates), format='%Y%m%d').values.astype('datetime64[D]').astype('int64')
+        # key = company code * span + day offset, sorted as the index is
+        day_base = min(known_day.min(initial=query_day.min()), query_day.min())
+        span = max(known_day.max(initial=query_day.max()), query_day.max()) - day_base + 1
+        keys = entity_code * span + known_day - day_base
+        query_code = np.arange(len(self.entity_ids), dtype='int64')[:, None]
+        position = np.searchsorted(keys, query_code * span + (query_day - day_base)[None, :], side='right') - 1
+        found = (position >= 0) & (entity_code[np.maximum(position, 0)] == query_code)
+
+        return np.where(found, ttm[np.maximum(position, 0)], np.nan)
+
+
+@func_timer
+def calculate_point_in_time_cost(rd_index, table_name=''):
+    """
+        r&d session cost known at session end: RD_Q(t-1) is the latest known ttm of any report, RD_SA(t-1) of half year
+        and annual reports, RD_A(t-1) of annual reports; RD_M(t-1) is RD_Q(t-1)
+    """
+    # define session dictionary
+    session_period_dict = {'M': 1, 'Q': 3, 'SA': 6, 'A': 12}
+    report_quarter_dict = {'Q': None, 'SA': (2, 4), 'A': (4,)}
+    session_end_list = get_session_table({'M': 1})['session_end'].to_numpy()
+    entity_ids = np.tile(rd_index.entity_ids, len(session_end_list))
+    df_rd_session = pd.DataFrame({'symbol': get_entity_dict().decode(entity_ids), 'entity_id': entity_ids,
+                                  'session_end': np.repeat(session_end_list, len(rd_index.entity_ids))})
+    for k, report_quarters in report_quarter_dict.items():
+        df_rd_session[f'RD_{k}(t-1)'] = rd_index.asof(session_end_list, report_quarters=report_quarters).T.ravel()
+    df_rd_session['RD_M(t-1)'] = df_rd_session['RD_Q(t-1)']
+    # adjust column order
+    fields = ['symbol', 'entity_id'] + [f'RD_{key}(t-1)' for key in session_period_dict.keys()] + ['session_end']
+    df_rd_session = df_rd_session[fields]
+    emit_log(config, _Script, f"{len(rd_index.entity_ids)} companies, {len(session_end_list)} sessions processed.")
+
+    # whether save to table
+    if table_name:
+        save_table(df_rd_session, table_name)
+
+    return df_rd_session
+
+
+def _get_quarter_column_index(columns, quarter_ordinal):
+    """
+    :param columns: quarterly PeriodIndex of the r&d pivot
+    :param quarter_ordinal: int array, year * 4 + quarter - 1
+    :return: int array of column positions, -1 for quarters not in the pivot
+    """
+    columns_ordinal = (columns.year * 4 + columns.quarter - 1).to_numpy()
+    position = pd.Index(columns_ordinal).get_indexer(quarter_ordinal)
+    return np.where(position >= 0, position, -1)
 
 
 @func_timer
-def calculate_year_long_cost(df_rd, save_csv=''):
+def calculate_year_long_cost(df_rd, table_name=''):
     """
         r&d session cost always uses year long cost, the only difference is how to cut period
+        例如t=2019Q1：
+        RD_Q(t-1) = r_and_d_cost(2018/09/30) + r_and_d_cost(2017/12/31) - r_and_d_cost(2017/09/30)
+        例如t=2019SA1：
+        RD_SA(t-1) = r_and_d_cost(2019/06/30) + r_and_d_cost(2018/12/31) - r_and_d_cost(2018/06/30)
+        t=2019SA2等价于2019A, RD_A(t-1) = r_and_d_cost(2018/12/31)
+        every session is mapped to its three quarter columns at once, and all sessions are computed by one fancy
+        indexing of the pivot
     """
     # define session dictionary
     session_period_dict = {'M': 1, 'Q': 3, 'SA': 6, 'A': 12}
-    df_rd_session = pd.DataFrame()
-    # outer loop: period
-    for k, v in session_period_dict.items():
-        # due to r&d data is published by quarter, use Q data for M
-        if k == 'M':
-            continue
-        # get session list
-        list_session_tuple = get_session_list(session_period_dict[k])[:-1]
-        df_tmp_session = pd.DataFrame()
-        # inner loop: session
-        for session in list_session_tuple:
-            df_tmp = pd.DataFrame()
-            session_end = session[-1]
-            if k == 'Q':
-                """
-                    例如t=2019Q1：
-                    RD_Q(t-1)=r_and_d_cost(2018/09/30) + r_and_d_cost(2017/12/31) - r_and_d_cost(2017/09/30)
-
-                """
-                session_period_last = str(
-                    pd.PeriodIndex([pd.to_datetime(session_end) - relativedelta(months=v)], freq='Q')[0])
-                session_period_last_year = str(
-                    pd.PeriodIndex([pd.to_datetime(session_end) - relativedelta(years=1, month=12)], freq='Q')[0])
-                session_period_last_in_last_year = str(
-                    pd.PeriodIndex([pd.to_datetime(session_end) - relativedelta(years=1, months=v)], freq='Q')[0])
-                # if session_period_last == '2020Q2':
-                #     continue
-                df = df_rd[session_period_last].astype('float') + df_rd[session_period_last_year].astype('float') -\
-                     df_rd[session_period_last_in_last_year].astype('float')
-            elif k == 'A':
-                session_period_last_year = str(
-                    pd.PeriodIndex([pd.to_datetime(session_end) - relativedelta(years=1, month=12)], freq='Q')[0])
-                df = df_rd[session_period_last_year].astype('float')
-            else:  # k == SA:
-                """
-                    例如t=2019SA1：
-                    RD_SA(t-1) = r_and_d_cost(2019/06/30) + r_and_d_cost(2018/12/31) - r_and_d_cost(2018/06/30)
-
-                    t=2019SA2等价于2019A
-                """
-                if pd.to_datetime(session_end).month >= 7:  # second half
-                    session_period_last = str(
-                        pd.PeriodIndex([pd.to_datetime(session_end) - relativedelta(month=6)], freq='Q')[0])
-                    session_period_last_year = str(
-                        pd.PeriodIndex([pd.to_datetime(session_end) - relativedelta(years=1, month=12)], freq='Q')[0])
-                    session_period_last_in_last_year = str(
-                        pd.PeriodIndex([pd.to_datetime(session_end) - relativedelta(years=1, month=6)], freq='Q')[0])
-                    df = df_rd[session_period_last].astype('float') + df_rd[session_period_last_year].astype('float') -\
-                         df_rd[session_period_last_in_last_year].astype('float')
-                else:   # fist half
-                    session_period_last_year = str(
-                        pd.PeriodIndex([pd.to_datetime(session_end) - relativedelta(years=1, month=12)], freq='Q')[0])
-                    df = df_rd[session_period_last_year].astype('float')
-            emit_log(config, _Script, f"{sys._getframe().f_code.co_name}|{k}:{session_end} processing ...")
-            df_tmp[f'RD_{k}(t-1)'] = df
-            df_tmp['symbol'] = df_rd.index.get_level_values(0)
-            df_tmp['session_end'] = session_end
-            df_tmp_session = pd.concat([df_tmp_session, df_tmp], axis=0, ignore_index=True)
-        # add symbol when comes up at 1st time
-        if 'symbol' not in df_rd_session.columns:
-            df_rd_session = pd.concat([df_rd_session, df_tmp_session], axis=1)
-        else:
-            df_rd_session = pd.concat([df_rd_session, df_tmp_session[f'RD_{k}(t-1)']], axis=1)
+    # due to r&d data is published by quarter, use Q data for M; the last session has no complete data
+    df_session = get_session_table(session_period_dict)
+    df_session = df_session[df_session['period'] != 'M']
+    df_session = df_session[df_session.groupby('period').cumcount(ascending=False) > 0]
+    period = df_session['period'].to_numpy()
+    session_end = pd.to_datetime(df_session['session_end'], format='%Y%m%d')
+    year = session_end.dt.year.to_numpy()
+    # month count since year 0, quarter ordinal = month count // 3
+    month_count = year * 12 + session_end.dt.month.to_numpy() - 1
+
+    # last year end for all; Q: last quarter and the same quarter last year; SA: last half year end and last year's
+    quarter_last_year = (year - 1) * 4 + 3
+    quarter_last = np.where(period == 'Q', (month_count - 3) // 3, year * 4 + 1)
+    quarter_last_in_last_year = np.where(period == 'Q', (month_count - 15) // 3, (year - 1) * 4 + 1)
+    # A and first half of SA only use last year end
+    single = (period == 'A') | ((period == 'SA') & (session_end.dt.month.to_numpy() < 7))
+
+    # column -1 is nan, for quarters not in the pivot
+    rd = np.column_stack([df_rd.to_numpy(dtype='float64'), np.full(len(df_rd), np.nan)])
+    rd_last_year = rd[:, _get_quarter_column_index(df_rd.columns, quarter_last_year)]
+    rd_session = np.where(single, rd_last_year,
+                          rd[:, _get_quarter_column_index(df_rd.columns, quarter_last)] + rd_last_year -
+                          rd[:, _get_quarter_column_index(df_rd.columns, quarter_last_in_last_year)])
+
+    # one column per period, rows of (session_end, company), sessions of every period end on the same dates
+    session_end_list = df_session.loc[period == 'Q', 'session_end'].to_numpy()
+    df_rd_session = pd.DataFrame({'symbol': np.tile(df_rd.index.get_level_values('symbol'), len(session_end_list)),
+                                  'entity_id': np.tile(df_rd.index.get_level_values('entity_id'),
+                                                       len(session_end_list)),
+                                  'session_end': np.repeat(session_end_list, len(df_rd))})
+    for k in pd.unique(period):
+        df_rd_session[f'RD_{k}(t-1)'] = rd_session[:, period == k].T.ravel()
+        emit_log(config, _Script, f"{sys._getframe().f_code.co_name}|{k}: {(period == k).sum()} sessions processed.")
     # due to r&d data is published by quarter, use Q data for M
     df_rd_session['RD_M(t-1)'] = df_rd_session['RD_Q(t-1)']
     # adjust column order
     fields = [f'RD_{key}(t-1)' for key in session_period_dict.keys()]
     fields.insert(0, 'symbol')
+    fields.insert(1, 'entity_id')
     fields.append('session_end')
     df_rd_session = df_rd_session[fields]
 
-    # whether save to csv file
-    if save_csv:
-        create_output_folder(__PATH_FILE, _OutputFolder)
-        df_rd_session.to_csv(os.path.join(__PATH_FILE, _OutputFolder, save_csv), index=False)
+    # whether save to table
+    if table_name:
+        save_table(df_rd_session, table_name)
+
+    return df_rd_session
 
 
 def main():
     emit_log(config, _Script, f"Program starts...")
     # process r&d cost data
-    df_rd_from_file = process_rd_data()
-    # r&d session cost always uses year long cost, the only difference is how to cut period
-    calculate_year_long_cost(df_rd_from_file, save_csv='rd_cost.csv')
+    df_rd = clean_rd_data()
+    if config.get('rd_point_in_time', True):
+        # r&d session cost known at session end, by announcement date or statutory disclosure deadline, no look-ahead
+        calculate_point_in_time_cost(RdAsOfIndex(df_rd), table_name='rd_cost')
+    else:
+        # legacy year long cost on the back filled pivot, only to reproduce old results (rd_point_in_time false), it
+        # uses reports announced after the session end
+        df_rd_from_file = process_rd_data(df_rd)
+        save_rd_matrix(df_rd_from_file)
+        # r&d session cost always uses year long cost, the only difference is how to cut period
+        calculate_year_long_cost(load_rd_matrix(), table_name='rd_cost')
 
     emit_log(config, _Script, f"All finished")
 
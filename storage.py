@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+    partitioned columnar store of the intermediate tables in Output, replaces the csv files
+    a table is a folder Output/<name>/ with one parquet file per partition, e.g. Output/stock_bar_marketcap/2019.parquet
+    dtypes and partitions of every table are declared in _SCHEMAS, readers push column selection and date range down
+    to partition files and parquet row groups
+"""
+__auth__ = 'Chen Chen'
+
+import glob
+import fnmatch
+import pandas as pd
+from helper import *
+
+__PATH_FILE = os.path.dirname(__file__)
+_OutputFolder = 'Output'
+
+_PATENT_DTYPES = {'symbol': 'str', 'entity_id': 'int32', 'PAT_M': 'int64', 'PAT_Q': 'int64', 'PAT_SA': 'int64',
+                  'PAT_A': 'int64', 'session_end': 'str'}
+# date: date column in YYYYMMDD string; partition: year/month of the date column, None for a single file
+_SCHEMAS = {
+    'stock_basic_overall': {
+        'date': None, 'partition': None,
+        'dtypes': {'ts_code': 'str', 'symbol': 'str', 'name': 'str', 'area': 'str', 'industry': 'str',
+                   'list_date': 'str', 'market': 'str', 'delist_date': 'str'}},
+    'entity': {
+        'date': None, 'partition': None,
+        'dtypes': {'entity_id': 'int32', 'ts_code': 'str', 'symbol': 'str', 'bbd_qyxx_id': 'str'}},
+    'stock_namechange': {
+        'date': None, 'partition': None,
+        'dtypes': {'ts_code': 'str', 'name': 'str', 'start_date': 'str', 'end_date': 'str', 'ann_date': 'str',
+                   'change_reason': 'str'}},
+    'stock_bar_marketcap': {
+        'date': 'trade_date', 'partition': 'year',
+        'dtypes': {'ts_code': 'str', 'trade_date': 'str', 'close': 'float64', 'vol': 'float64',
+                   'total_mv': 'float64'}},
+    'stock_bar_daily': {
+        'date': 'trade_date', 'partition': 'month',
+        'dtypes': {'ts_code': 'str', 'trade_date': 'str', 'close': 'float64', 'vol': 'float64',
+                   'adj_factor': 'float64', 'total_mv': 'float64'}},
+    'stock_adj_factor_latest': {
+        'date': None, 'partition': None,
+        'dtypes': {'ts_code': 'str', 'adj_factor': 'float64'}},
+    'daily_bar': {
+        'date': 'trade_date', 'partition': 'year',
+        'dtypes': {'ts_code': 'str', 'trade_date': 'str'}},
+    'shibor': {
+        'date': None, 'partition': None,
+        'dtypes': {'date': 'str', 'on': 'float64', '1w': 'float64', '2w': 'float64', '1m': 'float64', '3m': 'float64',
+                   '6m': 'float64', '9m': 'float64', '1y': 'float64'}},
+    'universe': {
+        'date': 'trade_date', 'partition': 'year',
+        'dtypes': {'trade_date': 'str', 'ts_code': 'str'}},
+    'excess_return': {
+        'date': 'session_date', 'partition': 'year',
+        'dtypes': {'symbol': 'str', 'entity_id': 'int32', 'session_date': 'str', 'er_1m': 'float64',
+                   'er_3m': 'float64', 'er_6m': 'float64', 'er_12m': 'float64', 'total_mv_1m': 'float64',
+                   'total_mv_3m': 'float64', 'total_mv_6m': 'float64', 'total_mv_12m': 'float64'}},
+    'patent_count_session': {
+        'date': 'session_end', 'partition': 'year', 'dtypes': _PATENT_DTYPES},
+    'patent_*_count_session': {
+        'date': 'session_end', 'partition': 'year', 'dtypes': _PATENT_DTYPES},
+    'rd_cost': {
+        'date': 'session_end', 'partition': 'year',
+        'dtypes': {'symbol': 'str', 'entity_id': 'int32', 'RD_M(t-1)': 'float64', 'RD_Q(t-1)': 'float64',
+                   'RD_SA(t-1)': 'float64', 'RD_A(t-1)': 'float64', 'session_end': 'str'}},
+    'factor': {
+        'date': 'session_end', 'partition': 'year',
+        'dtypes': {'symbol': 'str', 'entity_id': 'int32', 'session_end': 'str'}},
+}
+_DEFAULT_SCHEMA = {'date': None, 'partition': None, 'dtypes': dict()}
+
+
+def get_schema(name):
+    for pattern, schema in _SCHEMAS.items():
+        if fnmatch.fnmatchcase(name, pattern):
+            return schema
+    return _DEFAULT_SCHEMA
+
+
+def _get_path_table(name, sub_folder=''):
+    return os.path.join(__PATH_FILE, _OutputFolder, sub_folder, name)
+
+
+def _apply_dtypes(df, dtypes):
+    df = df.copy()
+    for column, dtype in dtypes.items():
+        if column not in df.columns:
+            continue
+        if dtype == 'str':
+            # keep missing values missing instead of 'nan'
+            df[column] = df[column].where(df[column].isnull(), df[column].astype(str))
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def _get_partition_key(dates, partition):
+    return dates.str[:4] if partition == 'year' else dates.str[:6]
+
+
+def _write_partition(df, path_file):
+    # write to a temporary file first, readers never see a half written partition
+    df.to_parquet(f"{path_file}.tmp", index=False)
+    os.replace(f"{path_file}.tmp", path_file)
+
+
+def save_table(df, name, sub_folder=''):
+    """
+    save dataframe as table Output/<sub_folder>/<name>/, old partitions of the table are replaced
+    :param df: dataframe
+    :param name: table name, e.g. stock_bar_marketcap
+    :param sub_folder: sub folder in Output
+    """
+    schema = get_schema(name)
+    path_table = _get_path_table(name, sub_folder)
+    os.makedirs(path_table, exist_ok=True)
+    for path_file in glob.glob(os.path.join(path_table, '*.parquet')):
+        os.remove(path_file)
+    df = _apply_dtypes(df, schema['dtypes'])
+    if schema['partition'] is None:
+        _write_partition(df, os.path.join(path_table, f"{name}.parquet"))
+    else:
+        df = df.sort_values(schema['date'], kind='mergesort')
+        for key, df_partition in df.groupby(_get_partition_key(df[schema['date']], schema['partition'])):
+            _write_partition(df_partition, os.path.join(path_table, f"{key}.parquet"))
+
+
+def append_table(df, name, keys, sub_folder=''):
+    """
+    append rows to a partitioned table, only partitions of the new rows are rewritten
+    :param keys: columns identifying a row, e.g. ['ts_code', 'trade_date'], new rows replace old ones with same keys
+    """
+    schema = get_schema(name)
+    path_table = _get_path_table(name, sub_folder)
+    os.makedirs(path_table, exist_ok=True)
+    df = _apply_dtypes(df, schema['dtypes'])
+    for key, df_partition in df.groupby(_get_partition_key(df[schema['date']], schema['partition'])):
+        path_file = os.path.join(path_table, f"{key}.parquet")
+        if os.path.exists(path_file):
+            df_partition = pd.concat([pd.read_parquet(path_file), df_partition], ignore_index=True)
+        df_partition = df_partition.drop_duplicates(keys, keep='last')
+        df_partition = df_partition.sort_values([schema['date']] + [k for k in keys if k != schema['date']],
+                                                ignore_index=True)
+        _write_partition(df_partition, path_file)
+
+
+def exists_table(name, sub_folder=''):
+    return len(glob.glob(os.path.join(_get_path_table(name, sub_folder), '*.parquet'))) > 0
+
+
+def read_table(name, columns=None, start_date=None, end_date=None, filters=None, sub_folder=''):
+    """
+    read table with column and date range pushdown
+    :param name: table name
+    :param columns: columns to read, default all
+    :param start_date: first date to read (YYYYMMDD, inclusive) of the date column of the table
+    :param end_date: last date to read (YYYYMMDD, inclusive) of the date column of the table
+    :param filters: extra pyarrow filters, e.g. [('ts_code', 'in', ['000001.SZ'])]
+    :param sub_folder: sub folder in Output
+    :return: dataframe, empty dataframe if the table does not exist
+    """
+    schema = get_schema(name)
+    path_files = sorted(glob.glob(os.path.join(_get_path_table(name, sub_folder), '*.parquet')))
+    filters = list(filters or list())
+    if schema['date'] is not None:
+        # skip partitions out of date range
+        if schema['partition'] is not None:
+            key_len = 4 if schema['partition'] == 'year' else 6
+            path_files = [path_file for path_file in path_files
+                          if (start_date is None or os.path.basename(path_file)[:key_len] >= start_date[:key_len])
+                          and (end_date is None or os.path.basename(path_file)[:key_len] <= end_date[:key_len])]
+        if start_date is not None:
+            filters.append((schema['date'], '>=', start_date))
+        if end_date is not None:
+            filters.append((schema['date'], '<=', end_date))
+    if any(f[1] == 'in' and len(f[2]) == 0 for f in filters):
+        path_files = list()
+    df_list = [pd.read_parquet(path_file, columns=columns, filters=filters or None) for path_file in path_files]
+    if not df_list:
+        return pd.DataFrame(columns=columns or list(schema['dtypes'].keys()))
+
+    return pd.concat(df_list, ignore_index=True)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+    checks of the panel kernels against pandas cross sections, run with python -m pytest test_panel_kernel.py
+"""
+__auth__ = 'Chen Chen'
+
+import numpy as np
+import pandas as pd
+import pytest
+from panel_kernel import to_panel, rank
+
+
+def _random_panel(seed=0, shape=(6, 40, 3)):
+    # integer values for ties, with nan and an all nan cross section
+    rng = np.random.default_rng(seed)
+    panel = rng.integers(0, 8, size=shape).astype('float64')
+    panel[rng.random(shape) < 0.2] = np.nan
+    panel[1, :, 2] = np.nan
+    return panel
+
+
+@pytest.mark.parametrize('pct', [False, True])
+def test_rank_matches_pandas(pct):
+    panel = _random_panel()
+    ranks = rank(panel, pct=pct)
+    assert ranks.shape == panel.shape
+    for k in range(panel.shape[2]):
+        expected = pd.DataFrame(panel[:, :, k]).rank(axis=1, method='average', pct=pct).to_numpy()
+        np.testing.assert_allclose(ranks[:, :, k], expected, rtol=0, atol=1e-12)
+
+
+def test_rank_keeps_nan():
+    panel = _random_panel(seed=1)
+    ranks = rank(panel)
+    assert np.array_equal(np.isnan(ranks), np.isnan(panel))
+    assert np.isnan(rank(panel, pct=True)[1, :, 2]).all()
+
+
+def test_rank_of_two_dimensional_panel():
+    panel = _random_panel(seed=2)[:, :, 0]
+    expected = pd.DataFrame(panel).rank(axis=1, method='average').to_numpy()
+    np.testing.assert_allclose(rank(panel), expected, rtol=0, atol=1e-12)
+
+
+def test_to_panel_rejects_missing_and_duplicated_keys():
+    df = pd.DataFrame({'session_end': ['20200131', '20200131', '20200228'], 'symbol': ['000001', '000002', None],
+                       'PAT_M': [1., 2., 3.]})
+    with pytest.raises(ValueError):
+        to_panel(df, 'session_end', 'symbol', ['PAT_M'])
+    df.loc[2, 'symbol'] = '000001'
+    panel, (date_index, stock_index) = to_panel(df, 'session_end', 'symbol', ['PAT_M'])
+    np.testing.assert_array_equal(panel[date_index, stock_index, 0], df['PAT_M'])
+    with pytest.raises(ValueError):
+        to_panel(pd.concat([df, df.iloc[[0]]]), 'session_end', 'symbol', ['PAT_M'])
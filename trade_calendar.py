@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+    local trading calendar built once from the cached trade_cal of tushare
+    first/last trade date of month, next/previous trade date and month offsets are answered by array lookups,
+    every query accepts a single date or an array of dates (YYYYMMDD)
+"""
+__auth__ = 'Chen Chen'
+
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+from tushare_api import get_pro_api
+from helper import *
+
+__PATH_FILE = os.path.dirname(__file__)
+_ConfigFolder = 'Config'
+_ConfigFile = 'config.json'
+_Script = os.path.basename(__file__).rstrip('.py')
+config = get_config(__PATH_FILE, _ConfigFolder, _ConfigFile)
+_CALENDAR_START_DATE = '19900101'
+
+_trade_calendar = None
+
+
+def _to_day(dates):
+    # YYYYMMDD string(s) or datetime(s) to datetime64[D] array
+    return pd.to_datetime(np.atleast_1d(dates), format='%Y%m%d').values.astype('datetime64[D]')
+
+
+def _to_str(days):
+    return np.char.replace(np.datetime_as_string(days, unit='D'), '-', '')
+
+
+def _format(days, dates, *args):
+    # scalar in, scalar out
+    days_str = _to_str(days)
+    if all(np.ndim(arg) == 0 for arg in (dates,) + args):
+        return str(days_str[0])
+    return days_str
+
+
+class TradeCalendar(object):
+    """
+    :param df_trade_cal: output of pro.trade_cal, columns cal_date and is_open, every calendar day in the range
+    """
+
+    def __init__(self, df_trade_cal):
+        df_trade_cal = df_trade_cal.sort_values('cal_date')
+        cal_days = _to_day(df_trade_cal['cal_date'].to_numpy())
+        self.first_day = cal_days[0]
+        self.last_day = cal_days[-1]
+        self.trade_days = cal_days[df_trade_cal['is_open'].astype(int).to_numpy() == 1]
+        # day offset -> index of trade day on or after / on or before the day
+        n_day = int((self.last_day - self.first_day).astype(int)) + 1
+        trade_day_offset = (self.trade_days - self.first_day).astype(int)
+        self._next_index = np.searchsorted(trade_day_offset, np.arange(n_day), side='left')
+        self._prev_index = np.searchsorted(trade_day_offset, np.arange(n_day), side='right') - 1
+        # month offset -> index of first / last trade day in the month
+        self.first_month = self.first_day.astype('datetime64[M]')
+        n_month = int((self.last_day.astype('datetime64[M]') - self.first_month).astype(int)) + 1
+        trade_month_offset = (self.trade_days.astype('datetime64[M]') - self.first_month).astype(int)
+        self._month_first_index = np.searchsorted(trade_month_offset, np.arange(n_month), side='left')
+        self._month_last_index = np.searchsorted(trade_month_offset, np.arange(n_month), side='right') - 1
+        self._month_has_trade_day = self._month_first_index <= self._month_last_index
+
+    def _day_offset(self, dates):
+        days = _to_day(dates)
+        if (days < self.first_day).any() or (days > self.last_day).any():
+            raise ValueError(f"dates out of trade calendar {_to_str(self.first_day)} - {_to_str(self.last_day)}.")
+        return (days - self.first_day).astype(int)
+
+    def _month_lookup(self, dates, months, month_index):
+        """
+        trade day of month(dates) + months, month without trade day (e.g. out of calendar in future) falls back to
+        the calendar month end, the same as the previous tushare query
+        """
+        target_month = _to_day(dates).astype('datetime64[M]') + np.asarray(months, dtype=int)
+        month_offset = (target_month - self.first_month).astype(int)
+        in_calendar = (month_offset >= 0) & (month_offset < len(month_index))
+        month_offset_clip = np.clip(month_offset, 0, len(month_index) - 1)
+        valid = in_calendar & self._month_has_trade_day[month_offset_clip]
+        month_end = (target_month + 1).astype('datetime64[D]') - 1
+        return np.where(valid, self.trade_days[np.clip(month_index[month_offset_clip], 0, len(self.trade_days) - 1)],
+                        month_end)
+
+    def first_trade_date_of_month(self, dates, months=0):
+        """
+        :param dates: date(s), YYYYMMDD
+        :param months: month offset(s), e.g. -1 for previous month, broadcast with dates
+        :return: first trade date of the month
+        """
+        return _format(self._month_lookup(dates, months, self._month_first_index), dates, months)
+
+    def last_trade_date_of_month(self, dates, months=0):
+        """
+        :param dates: date(s), YYYYMMDD
+        :param months: month offset(s), e.g. 3 for 3 months later, broadcast with dates
+        :return: last trade date of the month
+        """
+        return _format(self._month_lookup(dates, months, self._month_last_index), dates, months)
+
+    def next_trade_date(self, dates, inclusive=False):
+        """
+        :return: first trade date after dates (on or after if inclusive)
+        """
+        day_offset = self._day_offset(dates) + (0 if inclusive else 1)
+        index = self._next_index[np.minimum(day_offset, len(self._next_index) - 1)]
+        return _format(self.trade_days[np.minimum(index, len(self.trade_days) - 1)], dates)
+
+    def prev_trade_date(self, dates, inclusive=False):
+        """
+        :return: last trade date before dates (on or before if inclusive)
+        """
+        day_offset = self._day_offset(dates) - (0 if inclusive else 1)
+        index = self._prev_index[np.maximum(day_offset, 0)]
+        return _format(self.trade_days[np.maximum(index, 0)], dates)
+
+    def is_trade_date(self, dates):
+        days = _to_day(dates)
+        index = np.clip(np.searchsorted(self.trade_days, days), 0, len(self.trade_days) - 1)
+        is_open = self.trade_days[index] == days
+        return bool(is_open[0]) if np.ndim(dates) == 0 else is_open
+
+    def get_trade_dates(self, start_date, end_date):
+        """
+        :return: trade dates between start_date and end_date (inclusive), ascending
+        """
+        start, end = _to_day([start_date, end_date])
+        return _to_str(self.trade_days[(self.trade_days >= start) & (self.trade_days <= end)]).tolist()
+
+
+def get_end_date():
+    # if end_date is not specified in config.json, end_date is today
+    if config.get('end_date') == -1:
+        return datetime.datetime.today()
+    return pd.to_datetime(config.get('end_date'))
+
+
+def get_trade_calendar():
+    """
+    :return: trade calendar shared by the whole process, built from one (cached) trade_cal query
+    """
+    global _trade_calendar
+    if _trade_calendar is None:
+        # cover 12 forward months of the last session for excess return
+        end_date = (get_end_date() + relativedelta(years=1, month=12, day=31)).strftime('%Y%m%d')
+        df_trade_cal = get_pro_api().trade_cal(start_date=_CALENDAR_START_DATE, end_date=end_date)
+        _trade_calendar = TradeCalendar(df_trade_cal)
+    return _trade_calendar
+
+
+@func_timer
+def get_session_table(session_period_dict=None):
+    """
+    monthly sessions of the last time_len years before end_date, for every session length in one pass
+    :param session_period_dict: period -> length of a session in months, default {'M': 1, 'Q': 3, 'SA': 6, 'A': 12}
+    :return: dataframe, columns period, session_start, session_end (first/last trade date of the session),
+             sorted by period in the order of session_period_dict, then session_end ascending
+    """
+    if session_period_dict is None:
+        session_period_dict = {'M': 1, 'Q': 3, 'SA': 6, 'A': 12}
+    calendar = get_trade_calendar()
+    end_date = get_end_date().strftime('%Y%m%d')
+    periods = np.array(list(session_period_dict.keys()))
+    months = np.array(list(session_period_dict.values()))
+    # session i ends in the (i + 1)th month before end_date, and starts months - 1 months earlier, period x session
+    end_months = -np.arange(config.get('time_len') * 12, 0, -1)
+    start_months = end_months[None, :] - months[:, None] + 1
+    end_months = np.broadcast_to(end_months, start_months.shape)
+    df_session = pd.DataFrame({
+        'period': np.repeat(periods, start_months.shape[1]),
+        'session_start': calendar.first_trade_date_of_month(end_date, months=start_months.ravel()),
+        'session_end': calendar.last_trade_date_of_month(end_date, months=end_months.ravel()),
+    })
+
+    return df_session
+
+
+def get_session_dict(df_session):
+    """
+    :param df_session: output of get_session_table
+    :return: period -> list of (session_start, session_end), ascending
+    """
+    return {period: list(zip(df['session_start'].tolist(), df['session_end'].tolist()))
+            for period, df in df_session.groupby('period', sort=False)}
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+    shared tushare pro api for all scripts
+    every request goes through a token bucket of its endpoint, quotas (requests per minute) are set by
+    rate_limit in config.json, and quota errors are retried with exponential backoff
+    per-stock/per-date requests can be run concurrently by map_concurrent, max_workers in config.json bounds
+    the requests in flight
+    responses are cached on disk by endpoint and parameters with a ttl per endpoint (cache_ttl in config.json), every
+    backend (tushare_backend in config.json) has its own cache folder, empty responses are never cached, run any
+    script with --offline (or set "offline": true) to replay from the cache without network
+"""
+__auth__ = 'Chen Chen'
+
+import sys
+import hashlib
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import tushare as ts
+from helper import *
+
+__PATH_FILE = os.path.dirname(__file__)
+_ConfigFolder = 'Config'
+_ConfigFile = 'config.json'
+_CacheFolder = 'Cache'
+_Script = os.path.basename(__file__).rstrip('.py')
+config = get_config(__PATH_FILE, _ConfigFolder, _ConfigFile)
+_OFFLINE = '--offline' in sys.argv or bool(config.get('offline'))
+
+_pro_api = None
+_pro_api_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """
+    token bucket limiter
+    :param rate: requests allowed per minute
+    :param capacity: maximum burst of requests
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate) / 60
+        self.capacity = capacity
+        self._tokens = capacity
+        self._timestamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._timestamp) * self.rate)
+            self._timestamp = now
+            # reserve a token, negative tokens are the slots already reserved by other callers
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+def _is_quota_error(e):
+    # e.g. 抱歉，您每分钟最多访问该接口200次，权限的具体详情访问：https://tushare.pro/document/1?doc_id=108。
+    return '最多访问' in str(e)
+
+
+class ResponseCache(object):
+    """
+    on-disk cache of tushare responses, one parquet file per request, addressed by the hash of endpoint and parameters
+    :param path_folder: cache folder
+    :param ttl: seconds a response of an endpoint stays valid, e.g. {'default': 86400, 'trade_cal': 604800};
+                -1 never expires, 0 is not cached
+    :param offline: replay mode, expired responses are still used
+    """
+
+    def __init__(self, path_folder, ttl, offline=False):
+        self.path_folder = path_folder
+        self.ttl = ttl
+        self.offline = offline
+
+    def _get_ttl(self, api_name):
+        return self.ttl.get(api_name, self.ttl.get('default'))
+
+    def _get_path(self, api_name, fields, params):
+        request = json.dumps({'api_name': api_name, 'fields': fields, 'params': params}, sort_keys=True, default=str)
+        key = hashlib.sha1(request.encode('utf-8')).hexdigest()
+        return os.path.join(self.path_folder, api_name, f"{key}.parquet")
+
+    def get(self, api_name, fields, params):
+        """
+        :return: cached dataframe, None if not cached or expired
+        """
+        path = self._get_path(api_name, fields, params)
+        if not os.path.exists(path):
+            return None
+        ttl = self._get_ttl(api_name)
+        if not self.offline and (ttl == 0 or (ttl > 0 and time.time() - os.path.getmtime(path) > ttl)):
+            return None
+        return pd.read_parquet(path)
+
+    def put(self, api_name, fields, params, df):
+        # empty responses are not cached, e.g. daily of today before tushare publishes the bars
+        if self._get_ttl(api_name) == 0 or df is None or df.empty:
+            return
+        path = self._get_path(api_name, fields, params)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first, readers never see a half written file
+        path_tmp = f"{path}.{threading.get_ident()}.tmp"
+        df.to_parquet(path_tmp, index=False)
+        os.replace(path_tmp, path)
+
+
+class RateLimitedProApi(object):
+    """
+    drop-in replacement of ts.pro_api(), e.g. pro.daily(...), pro.query('daily', ...) and ts.pro_bar(api=pro, ...)
+    """
+
+    def __init__(self, pro, rate_limit, max_retry=5, backoff=5, cache=None):
+        self._pro = pro
+        self._rate_limit = rate_limit
+        self._max_retry = max_retry
+        self._backoff = backoff
+        self._cache = cache
+        self._buckets = dict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _get_bucket(self, api_name):
+        with self._lock:
+            if api_name not in self._buckets:
+                rate = self._rate_limit.get(api_name, self._rate_limit.get('default'))
+                self._buckets[api_name] = TokenBucket(rate)
+        return self._buckets[api_name]
+
+    def query(self, api_name, fields='', **kwargs):
+        if self._cache is not None:
+            df = self._cache.get(api_name, fields, kwargs)
+            if df is not None:
+                return df
+            if self._cache.offline:
+                # ts.pro_bar catches the error and returns None, keep the miss for pop_offline_miss
+                self._local.offline_miss = f"{api_name} {kwargs}"
+                raise IOError(f"{api_name} {kwargs} is not cached, can not replay offline.")
+        df = self._query_remote(api_name, fields, **kwargs)
+        if self._cache is not None:
+            self._cache.put(api_name, fields, kwargs, df)
+
+        return df
+
+    def pop_offline_miss(self):
+        """
+        :return: last request of the current thread not found in the cache offline, None if none, cleared after call
+        """
+        offline_miss = getattr(self._local, 'offline_miss', None)
+        self._local.offline_miss = None
+        return offline_miss
+
+    def _query_remote(self, api_name, fields='', **kwargs):
+        bucket = self._get_bucket(api_name)
+        for retry in range(self._max_retry + 1):
+            bucket.acquire()
+            try:
+                return self._pro.query(api_name, fields=fields, **kwargs)
+            except Exception as e:
+                if not _is_quota_error(e) or retry == self._max_retry:
+                    raise
+                wait = self._backoff * 2 ** retry
+                emit_log(config, _Script, f"{api_name} quota exceeded, retry {retry + 1} in {wait} s: {e}")
+                time.sleep(wait)
+
+    def __getattr__(self, name):
+        return partial(self.query, name)
+
+
+def get_pro_api():
+    """
+    :return: the rate limited pro api shared by the whole process, so that quotas are counted together
+    """
+    global _pro_api
+    with _pro_api_lock:
+        if _pro_api is None:
+            # tushare_backend: tushare, query tushare.pro; fake, query local fake for offline benchmark
+            backend = config.get('tushare_backend')
+            if backend == 'fake':
+                from fake_tushare import FakeProApi
+                pro = FakeProApi(latency=float(config.get('fake_latency')))
+            else:
+                pro = ts.pro_api(token=config.get('token'), timeout=float(config.get('timeout')))
+            # responses of different backends never mix
+            cache = ResponseCache(os.path.join(__PATH_FILE, _CacheFolder, backend), config.get('cache_ttl'),
+                                  offline=_OFFLINE)
+            _pro_api = RateLimitedProApi(pro, config.get('rate_limit'), max_retry=config.get('rate_limit_retry'),
+                                         backoff=config.get('rate_limit_backoff'), cache=cache)
+    return _pro_api
+
+
+def map_concurrent(func, items, max_workers=None):
+    """
+    run func(item) for every item in a thread pool, quotas are still respected since all threads share the
+    token buckets of get_pro_api()
+    :param func: function querying tushare for a single item, e.g. a stock code or a trade date
+    :param items: list of items
+    :param max_workers: maximum requests in flight, default is max_workers in config.json
+    :return: list of results, in the same order as items
+    """
+    if max_workers is None:
+        max_workers = int(config.get('max_workers'))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(func, items))
+
+    return results
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+    tradable universe of every trade date, as a boolean trade date x stock matrix computed in one vectorized pass
+    a stock is in the universe on a date if
+        1. it is listed kickoff_days (config.json) before the date,
+        2. it is not ST/*ST/SST/S*ST on the date,
+        3. it has a bar on the date, i.e. it is not suspended
+    S：还没有进行或完成股改的股票；
+    ST：这是对连续两个会计年度都出现亏损的公司施行的特别处理；
+    *ST：是连续三年亏损，有退市风险的意思，购买这样的股票要有比较好的基本面分析能力；
+    S*ST：指公司经营连续三年亏损，进行退市预警和还没有完成股改；
+    SST：指公司经营连续二年亏损进行的特别处里和还没有完成股改；
+    NST：经过重组或股改重新恢复上市的ST股。
+    the universe is saved as table universe, (trade_date, ts_code) of stocks in the universe, and read back by
+    factor_processing, linear_models and alphalens_plot
+"""
+__auth__ = 'Chen Chen'
+
+import numpy as np
+import pandas as pd
+from storage import save_table, read_table
+from entity import get_entity_dict
+from helper import *
+
+__PATH_FILE = os.path.dirname(__file__)
+_ConfigFolder = 'Config'
+_ConfigFile = 'config.json'
+_Script = os.path.basename(__file__).rstrip('.py')
+config = get_config(__PATH_FILE, _ConfigFolder, _ConfigFile)
+# key of interval (stock, date) in one sorted array, stock * _STOCK_STRIDE + YYYYMMDD
+_STOCK_STRIDE = 10 ** 8
+
+
+def _to_day(dates):
+    # YYYYMMDD strings to datetime64[D], missing dates are NaT
+    return pd.to_datetime(pd.Series(dates), format='%Y%m%d').values.astype('datetime64[D]')
+
+
+def _to_int(dates):
+    # YYYYMMDD strings to int64, order is kept
+    return np.asarray(dates, dtype=str).astype(np.int64)
+
+
+class StIntervalIndex(object):
+    """
+    ST periods of every stock as sorted, merged intervals (start_date, end_date], built once from stock_namechange
+    if ST in its name and the date is after start_date and on or before end_date, the stock is a ST/*ST/SST/S*ST
+    stock on the date, name change without start_date/end_date is not counted
+    intervals of all stocks are kept in one array sorted by (stock, start_date), overlapping intervals of a stock are
+    merged so that end_date is sorted as well, every query is a searchsorted on this array
+    :param df_namechange: columns ts_code, name, start_date and end_date
+    """
+
+    def __init__(self, df_namechange):
+        df_st = df_namechange[df_namechange['name'].str.contains('ST', na=False)]
+        df_st = df_st.dropna(subset=['ts_code', 'start_date', 'end_date'])
+        self.ts_codes = pd.Index(np.sort(df_st['ts_code'].unique()))
+        df = pd.DataFrame({'stock': self.ts_codes.get_indexer(df_st['ts_code']),
+                           'start': _to_int(df_st['start_date']), 'end': _to_int(df_st['end_date'])})
+        df = df[df['start'] < df['end']].sort_values(['stock', 'start'], ignore_index=True)
+        # merge (s1, e1] and (s2, e2] of a stock if s2 <= max end of previous intervals
+        end_cummax = df.groupby('stock')['end'].cummax()
+        is_new = (df['stock'] != df['stock'].shift()) | (df['start'] > end_cummax.shift())
+        df = df.groupby(is_new.cumsum()).agg(stock=('stock', 'first'), start=('start', 'min'), end=('end', 'max'))
+        self._stock = df['stock'].to_numpy()
+        self._start_key = self._stock * _STOCK_STRIDE + df['start'].to_numpy()
+        self._end = df['end'].to_numpy()
+
+    def __len__(self):
+        return len(self._end)
+
+    def _last_interval(self, stock, dates):
+        # last interval of the stock starting before the date, -1 if none
+        position = np.searchsorted(self._start_key, stock * _STOCK_STRIDE + dates, side='left') - 1
+        position_clip = np.maximum(position, 0)
+        return np.where((position >= 0) & (self._stock[position_clip] == stock), position_clip, -1)
+
+    def is_st(self, dates, ts_codes):
+        """
+        which stocks are ST on every date, one batched searchsorted
+        :param dates: dates, YYYYMMDD
+        :param ts_codes: stocks
+        :return: boolean array, dates x ts_codes
+        """
+        dates = _to_int(dates)
+        stock = self.ts_codes.get_indexer(np.asarray(ts_codes, dtype=object))
+        st = np.zeros((len(dates), len(stock)), dtype=bool)
+        if len(self) == 0:
+            return st
+        # only stocks ever ST are queried
+        column = np.flatnonzero(stock >= 0)
+        interval = self._last_interval(stock[column][None, :], dates[:, None])
+        st[:, column] = (interval >= 0) & (self._end[np.maximum(interval, 0)] >= dates[:, None])
+
+        return st
+
+    def ever_st(self, ts_codes, start_date, end_date):
+        """
+        whether stocks are ST on any date of the window [start_date, end_date], O(log k) per stock
+        :param ts_codes: stock or stocks
+        :param start_date: first date of the window, YYYYMMDD, broadcast with ts_codes
+        :param end_date: last date of the window, YYYYMMDD, broadcast with ts_codes
+        :return: bool, or boolean array for stocks
+        """
+        stock = self.ts_codes.get_indexer(np.atleast_1d(np.asarray(ts_codes, dtype=object)))
+        start, end = _to_int(np.atleast_1d(start_date)), _to_int(np.atleast_1d(end_date))
+        if len(self) == 0:
+            ever = np.zeros(len(stock), dtype=bool)
+        else:
+            # end of the last interval starting before the window end is the largest one, ends are sorted
+            interval = self._last_interval(stock, end)
+            ever = (interval >= 0) & (self._end[np.maximum(interval, 0)] >= start)
+
+        return bool(ever[0]) if np.ndim(ts_codes) == 0 else ever
+
+
+@func_timer
+def build_universe(dates, df_stock_basic, df_namechange, df_bar):
+    """
+    :param dates: trade dates, YYYYMMDD
+    :param df_stock_basic: columns ts_code and list_date
+    :param df_namechange: columns ts_code, name, start_date and end_date, e.g. 摘星，改名，股改，ST，*ST etc.
+    :param df_bar: bar data, columns ts_code and trade_date
+    :return: boolean dataframe, trade date x ts_code of df_stock_basic, True if the stock is in the universe
+    """
+    dates = np.asarray(dates, dtype=object)
+    ts_codes = pd.unique(df_stock_basic['ts_code'])
+    day = _to_day(dates)
+
+    # 1. kick off new stocks listed less than kickoff_days before the date
+    kickoff_days = int(config.get('kickoff_days'))
+    list_day = _to_day(df_stock_basic.drop_duplicates('ts_code')['list_date'].to_numpy())
+    listed = list_day[None, :] < (day - np.timedelta64(kickoff_days, 'D'))[:, None]
+
+    # 2. st related stocks
+    st = StIntervalIndex(df_namechange).is_st(dates, ts_codes)
+
+    # 3. kick off suspended stocks, which have no bar on the date
+    bar_date = pd.Index(dates).get_indexer(df_bar['trade_date'])
+    bar_stock = pd.Index(ts_codes).get_indexer(df_bar['ts_code'])
+    has_bar = (bar_date >= 0) & (bar_stock >= 0)
+    traded = np.zeros((len(dates), len(ts_codes)), dtype=bool)
+    traded[bar_date[has_bar], bar_stock[has_bar]] = True
+
+    universe = listed & ~st & traded
+    emit_log(config, _Script, f"{len(dates)} dates, {len(ts_codes)} stocks: {listed.sum(axis=1).mean():.0f} stocks "
+                              f"listed, {st.sum(axis=1).mean():.0f} ST/*ST, {universe.sum(axis=1).mean():.0f} "
+                              f"selected on average.")
+
+    return pd.DataFrame(universe, index=pd.Index(dates, name='trade_date'), columns=pd.Index(ts_codes, name='ts_code'))
+
+
+def save_universe(df_universe):
+    """
+    :param df_universe: output of build_universe, saved as table universe
+    """
+    date_index, stock_index = np.nonzero(df_universe.to_numpy())
+    save_table(pd.DataFrame({'trade_date': df_universe.index.to_numpy()[date_index],
+                             'ts_code': df_universe.columns.to_numpy()[stock_index]}), 'universe')
+
+
+def read_universe(start_date=None, end_date=None):
+    """
+    :return: boolean dataframe, trade date x ts_code, read from table universe
+    """
+    df = read_table('universe', start_date=start_date, end_date=end_date)
+    return pd.crosstab(df['trade_date'], df['ts_code']).astype(bool)
+
+
+def in_universe(dates, codes, key='symbol', df_universe=None):
+    """
+    :param dates: dates of rows, YYYYMMDD
+    :param codes: stock codes of rows, ts_code or symbol
+    :param key: ts_code or symbol
+    :param df_universe: output of build_universe or read_universe, default read from table universe
+    :return: boolean array, True if the stock of the row is in the universe on the date of the row
+    """
+    dates = np.asarray(dates, dtype=object)
+    if df_universe is None:
+        df_universe = read_universe(start_date=min(dates, default=None), end_date=max(dates, default=None))
+    ts_codes = df_universe.columns.to_numpy()
+    if key != 'ts_code':
+        ts_codes = get_entity_dict().convert(ts_codes, 'ts_code', key)
+    date_index = df_universe.index.get_indexer(dates)
+    stock_index = pd.Index(ts_codes).get_indexer(np.asarray(codes, dtype=object))
+    found = (date_index >= 0) & (stock_index >= 0)
+
+    return found & df_universe.to_numpy()[np.maximum(date_index, 0), np.maximum(stock_index, 0)]